@@ -0,0 +1,303 @@
+#! /bin/env python
+
+###################################################################################
+#                                                                                 #
+#  Stitch v3.0, benchmarks                                                        #
+#  http://www.jportsmouth.com/code/Stitch/stitch.html                             #
+#  Copyright (C) 2009-2010 Jamie Portsmouth (jamports@mac.com)                    #
+#                                                                                 #
+#  This program is free software: you can redistribute it and/or modify           #
+#  it under the terms of the GNU General Public License as published by           #
+#  the Free Software Foundation, either version 3 of the License, or              #
+#  (at your option) any later version.                                            #
+#                                                                                 #
+#  This program is distributed in the hope that it will be useful,                #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of                 #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                  #
+#  GNU General Public License for more details.                                   #
+#                                                                                 #
+#  You should have received a copy of the GNU General Public License              #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.          #
+#                                                                                 #
+###################################################################################
+
+# Benchmarks of map generation, without touching Google. A local HTTP server stands in for the tile
+# servers, serving synthetic 256x256 JPEG tiles (with a configurable latency, jitter and error rate) at
+# the same URLs as the real ones, with the Google host moved into the path. Each map size is made by
+# StitchedMap.generate() in a fresh process and empty tile store, which reports the wall time of each
+# phase, the download rate, the stitching rate and its peak memory use. For example
+#
+#     python benchmark.py --sizes 2000 8000 16000 --latency 0.05 --jitter 0.02 --json before.json
+#     python benchmark.py --sizes 2000 8000 16000 --latency 0.05 --jitter 0.02 --compare before.json
+
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import cStringIO
+import BaseHTTPServer
+import SocketServer
+
+from PIL import Image
+from PIL import ImageDraw
+
+
+# Map area of the benchmarks (lat0, lat1, lon0, lon1): London
+AREA = ('51.40', '51.60', '-0.40', '0.00')
+
+
+class TileHandler( BaseHTTPServer.BaseHTTPRequestHandler ):
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        server = self.server
+        server.lock.acquire()
+        delay = server.latency + server.random.uniform(-server.jitter, server.jitter)
+        failed = server.random.random() < server.errorRate
+        server.requests += 1
+        server.lock.release()
+
+        if delay > 0:
+            time.sleep(delay)
+
+        if failed:
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        # the same path always gets the same tile
+        data = server.tiles[hash(self.path) % len(server.tiles)]
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer( SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer ):
+
+    daemon_threads = True
+    request_queue_size = 1024   # the downloaders open many connections at once
+
+    def __init__(self, latency=0.0, jitter=0.0, errorRate=0.0, seed=1, variants=16):
+
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), TileHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = errorRate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+        # a few tiles of noisy image content, so that they compress like real ones
+        self.tiles = []
+        for n in range(0, variants):
+            im = Image.merge('RGB', [Image.effect_noise((256, 256), 20 + 4 * n).point(lambda v, k=k: (v + 60 * k) % 256)
+                                     for k in range(3)])
+            draw = ImageDraw.Draw(im)
+            for line in range(0, 8):
+                draw.line([(0, 32 * line + 2 * n), (255, 255 - 32 * line)], fill=(255, 255, 255), width=3)
+            fp = cStringIO.StringIO()
+            im.save(fp, 'JPEG', quality=85)
+            self.tiles.append(fp.getvalue())
+
+    def start(self):
+
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def baseUrl(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+
+def peakRSS():
+
+    # peak resident memory in MB, of this process and of any stitching processes it ran (ru_maxrss
+    # is in kilobytes on Linux, and bytes on Mac OS)
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def runCase(case):
+
+    # Make one map, in the current directory, from the tile server at case['url']. Returns the results.
+    import stitch
+
+    # send the requests to the local server, keeping the rest of each URL as it is
+    for name in ['NRM_URL', 'SAT_URL', 'PHY_URL', 'SKY_URL']:
+        url = getattr(stitch, name)
+        setattr(stitch, name, case['url'] + url[len('http://'):])
+
+    stitch.tileStore = stitch.DirectoryTileStore('./tiles')
+    stitch.printProgress = False
+    stitch.downloadBackend = case['backend']
+
+    gmap = stitch.StitchedMap(AREA[0:2], AREA[2:4], case['size'], -1, case['maptype'],
+                              streaming=case['streaming'], pipeline=case['pipeline'], inMemory=case['inMemory'],
+                              outputFormat=case['format'], processes=case['processes'])
+
+    # time each phase of generate(), by wrapping the methods it calls
+    phases = {}
+    def timed(name, method):
+        def run(*args):
+            started = time.time()
+            result = method(*args)
+            phases[name] = phases.get(name, 0.0) + time.time() - started
+            return result
+        return run
+    for name in ['download', 'stitch', 'downloadAndStitch', 'buildPyramid']:
+        setattr(gmap, name, timed(name, getattr(gmap, name)))
+
+    threads = stitch.startDownloaders()
+    started = time.time()
+    missing = gmap.generate()
+    total = time.time() - started
+    stitch.stopDownloaders(threads)
+
+    box = gmap.getCropBox()
+    pixels = (box[2] - box[0]) * (box[3] - box[1])
+    downloadTime = phases.get('download', 0.0) + phases.get('downloadAndStitch', 0.0)
+    stitchTime = phases.get('stitch', 0.0) + phases.get('downloadAndStitch', 0.0)
+
+    return {'maptype': case['maptype'], 'size': case['size'], 'zoom': gmap.zoom,
+            'tiles': gmap.nX * gmap.nY, 'downloaded': stitch.metrics.tiles, 'missing': missing,
+            'phases': phases, 'total': total,
+            'tilesPerSecond': stitch.metrics.tiles / max(downloadTime, 1e-6),
+            'mapMegabytes': 3 * pixels / 1048576.0,
+            'stitchMegabytesPerSecond': 3 * pixels / 1048576.0 / max(stitchTime, 1e-6),
+            'peakRSS': peakRSS()}
+
+
+def runCaseProcess(case):
+
+    # Run a case in a new process and empty directory, so that each starts from nothing
+    directory = tempfile.mkdtemp(prefix='stitch-benchmark-')
+    try:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-case', json.dumps(case)],
+                                   cwd=directory, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise RuntimeError('benchmark of size %d failed' % case['size'])
+        return json.loads(output.strip().split('\n')[-1])
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def printResults(results, previous=None):
+
+    # previous results are matched by map type and size, and shown as a percentage change
+    before = {}
+    if previous:
+        for result in previous:
+            before[(result['maptype'], result['size'])] = result
+
+    print '\n%-10s %6s %5s %7s %10s %9s %9s %9s %11s %9s' % \
+          ('type', 'size', 'zoom', 'tiles', 'download s', 'stitch s', 'total s', 'tiles/s', 'stitch MB/s', 'peak MB')
+    for result in results:
+        phases = result['phases']
+        download = phases.get('download', phases.get('downloadAndStitch', 0.0))
+        stitching = phases.get('stitch', phases.get('downloadAndStitch', 0.0))
+        print '%-10s %6d %5d %7d %10.2f %9.2f %9.2f %9.1f %11.1f %9.1f' % \
+              (result['maptype'], result['size'], result['zoom'], result['tiles'], download, stitching,
+               result['total'], result['tilesPerSecond'], result['stitchMegabytesPerSecond'], result['peakRSS'])
+
+        old = before.get((result['maptype'], result['size']))
+        if old != None:
+            change = lambda key: 100.0 * (result[key] - old[key]) / max(old[key], 1e-6)
+            print '%-10s %6s %5s %7s %10s %9s %+8.0f%% %+8.0f%% %+10.0f%% %+8.0f%%' % \
+                  ('', '', '', '', '', '', change('total'), change('tilesPerSecond'),
+                   change('stitchMegabytesPerSecond'), change('peakRSS'))
+
+        if result['missing']:
+            print '%-10s %d tiles missing' % ('', result['missing'])
+
+
+def main(argv=None):
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Benchmark Stitch against a local stand-in tile server.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 8000, 16000],
+                        help='map sizes to make, in pixels along the long edge (default 2000 8000 16000)')
+    parser.add_argument('--type', dest='maptype', choices=['map', 'satellite', 'terrain', 'sky'], default='map')
+    parser.add_argument('--repeat', type=int, default=1, help='times to make each map, keeping the fastest (default 1)')
+
+    server = parser.add_argument_group('tile server')
+    server.add_argument('--latency', type=float, default=0.02, help='seconds before each response (default 0.02)')
+    server.add_argument('--jitter', type=float, default=0.0, help='random variation of the latency, in seconds (default 0)')
+    server.add_argument('--errors', type=float, default=0.0, help='fraction of requests which fail with HTTP 503 (default 0)')
+    server.add_argument('--seed', type=int, default=1, help='seed of the random latencies and errors (default 1)')
+
+    modes = parser.add_argument_group('stitching')
+    modes.add_argument('--backend', choices=['threads', 'async'], default='threads')
+    modes.add_argument('--streaming', action='store_true')
+    modes.add_argument('--pipeline', action='store_true')
+    modes.add_argument('--in-memory', action='store_true')
+    modes.add_argument('--format', dest='outputFormat', choices=['jpg', 'tiff', 'sheets'], default='jpg')
+    modes.add_argument('--processes', type=int, default=1)
+
+    output = parser.add_argument_group('results')
+    output.add_argument('--json', metavar='FILE', help='save the results to FILE')
+    output.add_argument('--compare', metavar='FILE', help='compare with results saved by an earlier run')
+
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+
+    args = parser.parse_args(argv)
+
+    if args.run_case:
+        # the subprocess making a single map: the results are printed as the last line
+        result = runCase(json.loads(args.run_case))
+        sys.stdout.flush()
+        print json.dumps(result)
+        return 0
+
+    tileServer = TileServer(args.latency, args.jitter, args.errors, args.seed)
+    tileServer.start()
+
+    results = []
+    for size in args.sizes:
+        case = {'url': tileServer.baseUrl(), 'size': size, 'maptype': args.maptype, 'backend': args.backend,
+                'streaming': args.streaming, 'pipeline': args.pipeline, 'inMemory': args.in_memory,
+                'format': args.outputFormat, 'processes': args.processes}
+        best = None
+        for n in range(0, args.repeat):
+            print 'Making %s map of size %d (run %d of %d) ..' % (args.maptype, size, n + 1, args.repeat)
+            result = runCaseProcess(case)
+            if best == None or result['total'] < best['total']:
+                best = result
+        results.append(best)
+
+    previous = None
+    if args.compare:
+        fp = open(args.compare)
+        previous = json.load(fp)
+        fp.close()
+    printResults(results, previous)
+    print '\n%d requests served' % tileServer.requests
+
+    if args.json:
+        fp = open(args.json, 'w')
+        json.dump(results, fp, indent=1, sort_keys=True)
+        fp.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -29,13 +29,30 @@
 
 import sys
 import os
-import urllib
+import errno
 import urllib2
+import httplib
+import urlparse
 import math
-import wx
-import wx.html
 import threading
 import Queue
+import asyncore
+import socket
+import time
+import sqlite3
+import cStringIO
+import collections
+import argparse
+import json
+import numpy
+import shutil
+import tempfile
+import struct
+import zlib
+import hashlib
+import heapq
+import mmap
+import multiprocessing
 
 from PIL import Image
 from PIL import ImageDraw
@@ -60,100 +77,1942 @@ SKY_URL = "http://mw1.google.com/mw-planetary/sky/skytiles_v1/0_0_0.jpg"
 ######################  end of map URL code section  ####################################################
 
 
-# Queue. We drop all the urls in this queue
-grabPool = Queue.Queue( 0 )
+# Queue. We drop all the urls in this queue. It is bounded, so that when the downloaders fall behind
+# the tile producer blocks, rather than every tile of a large job being queued at once.
+# Each work item is a list [url, tile store key, readyPool, (i, j), memoryTiles, persist, manifest,
+# retries so far, the job's list of failed tiles, whether a gap-filling pass is to follow, the queue
+# of the job's PreviewRenderer (or None)].
+grabPool = Queue.Queue( 1000 )
 LOCK = threading.Lock()
 
+# Progress lines from the download threads are written with a single write each, so they do not need
+# to hold LOCK to keep whole lines; printProgress turns them off.
+printProgress = True
+
+def progress(line):
+    if printProgress:
+        sys.stdout.write(line + '\n')
+
 numTilesDownloaded = 0
 numTilesToDownload = 0
 Terminate = False
 
-# Background threads. We start a few of these
-class ThreadingClass( threading.Thread ):
 
-    def __init__(self):
-        
+# Pool of persistent (keep-alive) HTTP connections, kept per tile server host (mt0..mt3, khm0.. etc.)
+# and shared by the download threads, so that each tile costs one request and no new TCP handshake.
+class ConnectionPool:
+
+    def __init__(self, maxsize=10, timeout=30.0):
+
+        self.maxsize = maxsize   # maximum number of idle connections kept open per host
+        self.timeout = timeout   # socket timeout in seconds
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def acquire(self, host):
+
+        self.lock.acquire()
+        try:
+            # a forked process (see stitchParallel) must not share the parent's connections
+            if self.pid != os.getpid():
+                self.idle = {}
+                self.pid = os.getpid()
+            connections = self.idle.get(host)
+            if connections:
+                return connections.pop()
+        finally:
+            self.lock.release()
+        return None
+
+    def release(self, host, connection):
+
+        self.lock.acquire()
+        try:
+            connections = self.idle.setdefault(host, [])
+            if len(connections) < self.maxsize:
+                connections.append(connection)
+                return
+        finally:
+            self.lock.release()
+        connection.close()
+
+    def fetch(self, url, fp):
+
+        # Request url and stream the response body into the file object fp.
+        # Raises an exception if the tile could not be fetched.
+        parts = urlparse.urlsplit(url)
+        host = parts.netloc
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+
+        # A pooled connection may have been closed by the server while idle, in which case
+        # the request is retried once on a fresh connection.
+        connection = self.acquire(host)
+        reused = connection != None
+        while True:
+            if connection == None:
+                connection = httplib.HTTPConnection(host, timeout=self.timeout)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                break
+            except (httplib.HTTPException, IOError):
+                connection.close()
+                if not reused:
+                    raise
+                connection = None
+                reused = False
+
+        try:
+            if response.status != 200:
+                response.read()
+                raise IOError('HTTP status %d for url %s' % (response.status, url))
+
+            while True:
+                chunk = response.read(16384)
+                if not chunk:
+                    break
+                fp.write(chunk)
+        except:
+            connection.close()
+            raise
+
+        if response.will_close:
+            connection.close()
+        else:
+            self.release(host, connection)
+
+
+connectionPool = ConnectionPool()
+
+
+def convertToBinary(x, n):
+
+    b = ''
+    for i in range(0,n):
+        b = str((x >> i) & 1) + b
+    return b   
+
+
+def satelliteTileCode(x, y, zoom):
+
+    # In satellite mode, the tiles are indexed by a sequence of the letters q, r, s, t, where
+    # there are 4^zoom tiles to index at each level. This works as indicated below:
+    #
+    #  zoom 0  zoom1      zoom 2              etc...
+    #
+    #  t       tq tr      tqq tqr   trq trr 
+    #          tt ts      tqt tqs   trt trs
+    #
+    #                     ttq ttr   tsq tsr 
+    #                     ttt tts   tst tss
+    
+    nTile = 1 << zoom
+   
+    if ((y < 0) or (nTile-1 < y)):
+        return 'x'
+    
+    if ((x < 0) or (nTile-1 < x)):
+        x = x % nTile
+        if (x < 0):
+            x += nTile;
+            
+    c = 't'
+
+    # convert each to zoom-digit binary representation 
+    bx = convertToBinary(x, zoom)
+    by = convertToBinary(y, zoom)
+
+    #                           q   r   s   t
+    #    left(0)/right(1) (x)   0   1   1   0
+    #    down(0)/up(1)    (y)   1   1   0   0
+
+    for i in range(0, zoom):
+
+        if (bx[i] == '0'):
+            if(by[i] == '0'):
+                c += 't'
+            else:
+                c += 'q'
+        else:
+            if(by[i] == '0'):
+                c += 's'
+            else:
+                c += 'r'
+           
+    return c
+
+
+# Inverse of satelliteTileCode(): returns the tile indices (x, y) of a satellite tile code
+def decodeSatelliteTileCode(code):
+
+    if not code.startswith('t'):
+        raise ValueError('Invalid satellite tile code ' + code)
+
+    # each letter gives one more bit of x and y (see the table in satelliteTileCode)
+    bits = { 'q': (0, 1), 'r': (1, 1), 's': (1, 0), 't': (0, 0) }
+    x = 0
+    y = 0
+    for c in code[1:]:
+        if c not in bits:
+            raise ValueError('Invalid satellite tile code ' + code)
+        x = (x << 1) | bits[c][0]
+        y = (y << 1) | bits[c][1]
+    return (x, y)
+
+
+# Vectorized versions of the above, for whole arrays of tiles at once. A quadkey is the integer whose
+# base 4 digits, from the most significant down, are the letters of the satellite tile code after the
+# leading 't', with t = 0, q = 1, s = 2, r = 3 (i.e. each digit is 2*xbit + ybit, so the quadkey is the
+# bit-interleaving of x and y).
+
+def spreadBits(v):
+
+    # move bit k of each (up to 32 bit) element of the uint64 array v to bit 2k
+    v = v & numpy.uint64(0x00000000FFFFFFFF)
+    v = (v | (v << numpy.uint64(16))) & numpy.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v << numpy.uint64(8)))  & numpy.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v << numpy.uint64(4)))  & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v << numpy.uint64(2)))  & numpy.uint64(0x3333333333333333)
+    v = (v | (v << numpy.uint64(1)))  & numpy.uint64(0x5555555555555555)
+    return v
+
+
+def compactBits(v):
+
+    # inverse of spreadBits(): move bit 2k of each element to bit k
+    v = v & numpy.uint64(0x5555555555555555)
+    v = (v | (v >> numpy.uint64(1)))  & numpy.uint64(0x3333333333333333)
+    v = (v | (v >> numpy.uint64(2)))  & numpy.uint64(0x0F0F0F0F0F0F0F0F)
+    v = (v | (v >> numpy.uint64(4)))  & numpy.uint64(0x00FF00FF00FF00FF)
+    v = (v | (v >> numpy.uint64(8)))  & numpy.uint64(0x0000FFFF0000FFFF)
+    v = (v | (v >> numpy.uint64(16))) & numpy.uint64(0x00000000FFFFFFFF)
+    return v
+
+
+def satelliteQuadkeys(x, y, zoom):
+
+    # Quadkeys of the satellite tiles with index arrays x, y (which are broadcast together), and a
+    # boolean array which is False where y is out of range (for which satelliteTileCode gives 'x').
+    # As in satelliteTileCode, x wraps around.
+    nTile = 1 << zoom
+    x = numpy.asarray(x, dtype=numpy.int64) % nTile
+    y = numpy.asarray(y, dtype=numpy.int64)
+    valid = (y >= 0) & (y < nTile)
+    y = numpy.where(valid, y, 0)
+    quadkeys = (spreadBits(x.astype(numpy.uint64)) << numpy.uint64(1)) | spreadBits(y.astype(numpy.uint64))
+    return (quadkeys, valid)
+
+
+def decodeQuadkeys(quadkeys):
+
+    # inverse of satelliteQuadkeys(): the tile indices (x, y) of an array of quadkeys
+    quadkeys = numpy.asarray(quadkeys, dtype=numpy.uint64)
+    x = compactBits(quadkeys >> numpy.uint64(1)).astype(numpy.int64)
+    y = compactBits(quadkeys).astype(numpy.int64)
+    return (x, y)
+
+
+def quadkeysToCodes(quadkeys, valid, zoom):
+
+    # Satellite tile code strings (as a NumPy bytes array) of an array of quadkeys
+    quadkeys = numpy.asarray(quadkeys, dtype=numpy.uint64)
+    shifts = numpy.arange(2*(zoom-1), -1, -2, dtype=numpy.uint64)
+    digits = (quadkeys[..., numpy.newaxis] >> shifts) & numpy.uint64(3)
+
+    letters = numpy.frombuffer('tqsr', dtype=numpy.uint8)
+    chars = numpy.empty(quadkeys.shape + (zoom+1,), dtype=numpy.uint8)
+    chars[..., 0] = ord('t')
+    chars[..., 1:] = letters[digits.astype(numpy.intp)]
+
+    codes = chars.view('S%d' % (zoom+1)).reshape(quadkeys.shape)
+    return numpy.where(valid, codes, 'x')
+
+
+def codesToQuadkeys(codes):
+
+    # inverse of quadkeysToCodes(), for an array of valid codes all of the same zoom level
+    codes = numpy.asarray(codes)
+    zoom = codes.dtype.itemsize - 1
+    chars = codes.view(numpy.uint8).reshape(codes.shape + (zoom+1,))[..., 1:]
+
+    values = numpy.zeros(256, dtype=numpy.uint64)
+    values[ord('q')] = 1
+    values[ord('s')] = 2
+    values[ord('r')] = 3
+    quadkeys = numpy.zeros(codes.shape, dtype=numpy.uint64)
+    for i in range(0, zoom):
+        quadkeys = (quadkeys << numpy.uint64(2)) | values[chars[..., i]]
+    return quadkeys
+
+
+# Tile stores. Tiles are identified by a key (maptype, zoom, x, y), where x, y are the Google tile
+# indices at that zoom level. A store provides contains(key), load(key) (returning the JPEG data, or
+# None), save(key, data), discard(key), describe(key) (a readable name for messages) and report()
+# (a summary of the tiles saved).
+# Many tiles (ocean, desert, empty sky) are byte for byte identical, so the stores keep only one copy
+# of each distinct tile content, identified by its SHA-1 digest.
+
+def makeDirectory(path):
+
+    # Create a directory if it does not exist yet. The download threads save tiles at the same time,
+    # so another one may create it first.
+    try:
+        os.mkdir(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+# The original tile cache: one file per tile, ./tiles/tile_<maptype>_<zoom>_<x>_<y>.jpg
+# (or ./tiles/tile_satellite_<zoom>_<code>.jpg for satellite tiles). Where the file system allows,
+# each tile file is a hard link to ./tiles/blobs/<digest>.jpg, so identical tiles share their data.
+class DirectoryTileStore:
+
+    def __init__(self, directory='./tiles'):
+
+        self.directory = directory
+        self.saved = 0
+        self.shared = 0
+        self.lock = threading.Lock()
+
+    def path(self, key):
+
+        (maptype, zoom, x, y) = key
+        if maptype == 'satellite':
+            name = satelliteTileCode(x, y, zoom)
+        else:
+            name = str(x) + '_' + str(y)
+        return os.path.join(self.directory, 'tile_' + maptype + '_' + str(zoom) + '_' + name + '.jpg')
+
+    def contains(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+
+        try:
+            fp = open(self.path(key), 'rb')
+        except IOError:
+            return None
+        data = fp.read()
+        fp.close()
+        return data
+
+    def blobPath(self, data):
+        return os.path.join(self.directory, 'blobs', hashlib.sha1(data).hexdigest() + '.jpg')
+
+    def save(self, key, data):
+
+        makeDirectory(self.directory)
+        path = self.path(key)
+        if os.path.exists(path):
+            os.remove(path)
+
+        if hasattr(os, 'link'):
+            blob = self.blobPath(data)
+            # the check for a shared copy, writing it and counting the tile are done under the lock, so
+            # that of several threads saving the same content only one writes it and counts it as new
+            self.lock.acquire()
+            try:
+                shared = self.matches(blob, data)
+                if not shared:
+                    makeDirectory(os.path.dirname(blob))
+                    # written under a temporary name and renamed over any damaged copy (leaving the tiles
+                    # linked to that one as they are), so that the blob is never seen half written
+                    temp = '%s.%d.tmp' % (blob, threading.current_thread().ident)
+                    fp = open(temp, 'wb')
+                    fp.write(data)
+                    fp.close()
+                    os.rename(temp, blob)
+                os.link(blob, path)
+                self.count(shared)
+                return
+            except OSError:
+                # no hard links on this file system: fall back to a file of its own
+                pass
+            finally:
+                self.lock.release()
+
+        fp = open(path, 'wb')
+        fp.write(data)
+        fp.close()
+        self.lock.acquire()
+        self.count(False)
+        self.lock.release()
+
+    def matches(self, blob, data):
+
+        # whether the shared copy exists and holds the data (it may have been damaged since it was written)
+        try:
+            if os.path.getsize(blob) != len(data):
+                return False
+            fp = open(blob, 'rb')
+            stored = fp.read()
+            fp.close()
+        except (IOError, OSError):
+            return False
+        return stored == data
+
+    def count(self, shared):
+
+        # called with self.lock held
+        self.saved += 1
+        if shared:
+            self.shared += 1
+
+    def discard(self, key):
+
+        data = self.load(key)
+        if data == None:
+            return
+        os.remove(self.path(key))
+
+        # remove the shared copy too once no tile links to it (under the lock, as save may be linking to it)
+        blob = self.blobPath(data)
+        self.lock.acquire()
+        try:
+            if os.path.exists(blob) and os.stat(blob).st_nlink == 1:
+                os.remove(blob)
+        finally:
+            self.lock.release()
+
+    def report(self):
+        return storeReport(self.saved, self.shared)
+
+    def describe(self, key):
+        return self.path(key)
+
+
+# All tiles packed into a single SQLite file, in a table laid out like MBTiles (with an extra maptype
+# column, as one file can hold several map types). If maxBytes is given, the least recently used tiles
+# are evicted whenever the total size of the stored tiles exceeds it.
+class SQLiteTileStore:
+
+    def __init__(self, path='./tiles.mbtiles', maxBytes=None):
+
+        self.path = path
+        self.maxBytes = maxBytes
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+        # the connection is shared by the download threads, serialized by self.lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.db.execute('CREATE TABLE IF NOT EXISTS tiles (maptype TEXT, zoom_level INTEGER, tile_column INTEGER, '
+                        'tile_row INTEGER, tile_data BLOB, size INTEGER, last_used INTEGER, '
+                        'PRIMARY KEY (maptype, zoom_level, tile_column, tile_row))')
+        self.db.execute('CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)')
+
+        # The data of each distinct tile is kept once in blobs, with a count of the tiles using it, and
+        # tiles refer to it by digest. (Tiles saved before this have their data in tiles.tile_data.)
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(tiles)')]
+        if 'digest' not in columns:
+            self.db.execute('ALTER TABLE tiles ADD COLUMN digest BLOB')
+        self.db.execute('CREATE TABLE IF NOT EXISTS blobs (digest BLOB PRIMARY KEY, tile_data BLOB, refs INTEGER)')
+        self.db.commit()
+
+        # last_used is a counter incremented on every access, giving the LRU order
+        row = self.db.execute('SELECT MAX(last_used), SUM(CASE WHEN digest IS NULL THEN size ELSE 0 END) FROM tiles').fetchone()
+        self.clock = row[0] or 0
+        self.totalBytes = (row[1] or 0) + (self.db.execute('SELECT SUM(LENGTH(tile_data)) FROM blobs').fetchone()[0] or 0)
+        self.saved = 0
+        self.shared = 0
+
+    def checkProcess(self):
+
+        # A forked process (such as a stitching process) cannot share its parent's connection or lock
+        if os.getpid() != self.pid:
+            self.pid = os.getpid()
+            self.lock = threading.Lock()
+            self.db = sqlite3.connect(self.path, check_same_thread=False)
+
+    def contains(self, key):
+
+        self.checkProcess()
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT 1 FROM tiles WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?',
+                                  key).fetchone()
+        finally:
+            self.lock.release()
+        return row != None
+
+    def load(self, key):
+
+        self.checkProcess()
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT tiles.tile_data, blobs.tile_data FROM tiles LEFT JOIN blobs ON tiles.digest = blobs.digest '
+                                  'WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?', key).fetchone()
+            if row == None:
+                return None
+            # updating the LRU order is not essential, so is skipped if another process has the database locked
+            self.clock += 1
+            try:
+                self.db.execute('UPDATE tiles SET last_used=? WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?',
+                                (self.clock,) + tuple(key))
+                self.db.commit()
+            except sqlite3.OperationalError:
+                pass
+        finally:
+            self.lock.release()
+        if row[0] == None:
+            return str(row[1])
+        return str(row[0])
+
+    def save(self, key, data):
+
+        digest = buffer(hashlib.sha1(data).digest())
+        self.checkProcess()
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT size, digest FROM tiles WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?',
+                                  key).fetchone()
+            if row != None:
+                self.release(row[0], row[1])
+
+            shared = self.db.execute('UPDATE blobs SET refs=refs+1 WHERE digest=?', (digest,)).rowcount > 0
+            if not shared:
+                self.db.execute('INSERT INTO blobs VALUES (?, ?, 1)', (digest, buffer(data)))
+                self.totalBytes += len(data)
+            self.saved += 1
+            if shared:
+                self.shared += 1
+
+            self.clock += 1
+            self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, NULL, ?, ?, ?)',
+                            tuple(key) + (len(data), self.clock, digest))
+            self.evict()
+            self.db.commit()
+        finally:
+            self.lock.release()
+
+    def release(self, size, digest):
+
+        # account for a tile being removed, deleting its data once no tile uses it (lock must be held)
+        if digest == None:
+            self.totalBytes -= size
+            return
+        self.db.execute('UPDATE blobs SET refs=refs-1 WHERE digest=?', (digest,))
+        if self.db.execute('DELETE FROM blobs WHERE digest=? AND refs<=0', (digest,)).rowcount > 0:
+            self.totalBytes -= size
+
+    def evict(self):
+
+        # remove least recently used tiles until the store is back under its size cap (lock must be held)
+        while self.maxBytes != None and self.totalBytes > self.maxBytes:
+            rows = self.db.execute('SELECT rowid, size, digest FROM tiles ORDER BY last_used LIMIT 64').fetchall()
+            if not rows:
+                break
+            for (rowid, size, digest) in rows:
+                if self.totalBytes <= self.maxBytes:
+                    break
+                self.db.execute('DELETE FROM tiles WHERE rowid=?', (rowid,))
+                self.release(size, digest)
+
+    def discard(self, key):
+
+        self.checkProcess()
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT size, digest FROM tiles WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?',
+                                  key).fetchone()
+            if row != None:
+                self.db.execute('DELETE FROM tiles WHERE maptype=? AND zoom_level=? AND tile_column=? AND tile_row=?', key)
+                self.release(row[0], row[1])
+                self.db.commit()
+        finally:
+            self.lock.release()
+
+    def describe(self, key):
+        return '%s_%d_%d_%d in %s' % (tuple(key) + (self.path,))
+
+    def report(self):
+        return storeReport(self.saved, self.shared)
+
+
+def storeReport(saved, shared):
+
+    ratio = float(saved) / max(saved - shared, 1)
+    return 'Tile store: %d tiles saved, %d identical to a stored tile (dedup ratio %.2f:1)' % (saved, shared, ratio)
+
+
+# Copy the tiles of an existing ./tiles style directory into another store (e.g. a SQLiteTileStore).
+# Files whose names cannot be parsed are left alone. Returns the number of tiles copied.
+def migrateTileDirectory(directory, store, removeFiles=False):
+
+    source = DirectoryTileStore(directory)
+    count = 0
+    for name in sorted(os.listdir(directory)):
+
+        if not (name.startswith('tile_') and name.endswith('.jpg')):
+            continue
+        fields = name[len('tile_'):-len('.jpg')].split('_')
+        try:
+            maptype = fields[0]
+            zoom = int(fields[1])
+            if maptype == 'satellite':
+                (x, y) = decodeSatelliteTileCode(fields[2])
+            else:
+                (x, y) = (int(fields[2]), int(fields[3]))
+        except (IndexError, ValueError):
+            print 'Skipping unrecognised file ' + name
+            continue
+
+        key = (maptype, zoom, x, y)
+        store.save(key, source.load(key))
+        if removeFiles:
+            source.discard(key)
+        count += 1
+
+    print 'Migrated %d tiles from %s' % (count, directory)
+    return count
+
+
+# The store used by the downloaders and the stitcher
+tileStore = DirectoryTileStore()
+
+
+# In-memory LRU cache of decoded tile images, keyed by the SHA-1 digest of the tile data, so that each
+# distinct tile is decoded once however many times it appears in the map (e.g. open ocean), and the
+# report gives the ratio of tiles looked up to tiles actually decoded. It lives for the whole session,
+# so that repeated or overlapping maps (e.g. successive runs from the GUI) do not decode the same JPEG
+# tiles again. The cache holds at most maxMegabytes of decoded pixels.
+class DecodedTileCache:
+
+    def __init__(self, maxMegabytes=256):
+
+        self.maxBytes = maxMegabytes * 1024 * 1024
+        self.images = collections.OrderedDict()
+        self.sizes = {}
+        self.totalBytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, identifier):
+
+        self.lock.acquire()
+        try:
+            im = self.images.pop(identifier, None)
+            if im == None:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self.images[identifier] = im
+            self.hits += 1
+            return im
+        finally:
+            self.lock.release()
+
+    def put(self, identifier, im):
+
+        size = im.size[0] * im.size[1] * len(im.getbands())
+        if size > self.maxBytes:
+            return
+
+        self.lock.acquire()
+        try:
+            if identifier in self.images:
+                del self.images[identifier]
+                self.totalBytes -= self.sizes.pop(identifier)
+            self.images[identifier] = im
+            self.sizes[identifier] = size
+            self.totalBytes += size
+
+            # evict least recently used images
+            while self.totalBytes > self.maxBytes:
+                (oldest, old) = self.images.popitem(last=False)
+                self.totalBytes -= self.sizes.pop(oldest)
+        finally:
+            self.lock.release()
+
+    def report(self):
+        return 'Decoded tile cache: %d hits, %d misses, %.1f MB in use (dedup ratio %.2f:1)' % \
+               (self.hits, self.misses, self.totalBytes/1048576.0, float(max(self.hits + self.misses, 1)) / max(self.misses, 1))
+
+
+tileCache = DecodedTileCache()
+
+
+# Writes tiles into the tile store in the background, for download-to-memory jobs which also keep
+# their tiles, so that the disk writes are off the critical path of the render.
+class WriteBehind( threading.Thread ):
+
+    def __init__(self):
+
+        self.pending = Queue.Queue(0)
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def put(self, key, data, saved=None):
+
+        # saved, if given, is called once the tile is in the store
+        self.pending.put((key, data, saved))
+
+    def flush(self):
+
+        # wait until everything queued so far is in the store
+        self.pending.join()
+
+    def run( self ):
+
+        while True:
+            (key, data, saved) = self.pending.get()
+            try:
+                tileStore.save(key, data)
+                if saved != None:
+                    saved()
+            except:
+                sys.stdout.write('Failed to write tile %s to the tile store\n' % tileStore.describe(key))
+            self.pending.task_done()
+
+
+writeBehind = None
+
+def startWriteBehind():
+
+    global writeBehind
+    if writeBehind == None:
+        writeBehind = WriteBehind()
+        writeBehind.start()
+    return writeBehind
+
+
+# Per-job record of which tiles have been stored, so that a job can be resumed without checking the tile
+# store for every tile (and without trusting every tile found there). The manifest file starts with a
+# line identifying the job, followed by fixed size records (x, y, state, size, crc32), appended (and
+# flushed) as each tile is stored or fails; the last record of a tile gives its state. Tiles with no
+# record are pending. x and y are relative to the lowest tile indices of the job.
+class JobManifest:
+
+    PENDING = 0
+    DONE = 1
+    FAILED = 2
+
+    RECORD = numpy.dtype([('x', '<u4'), ('y', '<u4'), ('state', 'u1'), ('size', '<u4'), ('crc', '<u4')])
+
+    def __init__(self, path, job, x0, y0, nX, nY):
+
+        self.path = path
+        self.x0 = x0
+        self.y0 = y0
+        self.states = numpy.zeros((nX, nY), numpy.uint8)
+        self.sizes = numpy.zeros((nX, nY), numpy.uint32)
+        self.crcs = numpy.zeros((nX, nY), numpy.uint32)
+        self.lock = threading.Lock()
+
+        header = 'tile-manifest 1 %s %d %d %d %d\n' % (job, x0, y0, nX, nY)
+        resumed = False
+        if os.path.exists(path):
+            fp = open(path, 'rb')
+            resumed = fp.readline() == header
+            if resumed:
+                body = fp.read()
+                records = numpy.frombuffer(body, self.RECORD, len(body) // self.RECORD.itemsize)
+                # keep only the last record of each tile
+                index = records['x'].astype(numpy.int64) * nY + records['y']
+                (unique, first) = numpy.unique(index[::-1], return_index=True)
+                records = records[len(records) - 1 - first]
+                self.states[records['x'], records['y']] = records['state']
+                self.sizes[records['x'], records['y']] = records['size']
+                self.crcs[records['x'], records['y']] = records['crc']
+            fp.close()
+
+            # drop a partial record left by a crash while it was written, so that the records
+            # appended from now on line up
+            if resumed and len(body) % self.RECORD.itemsize:
+                fp = open(path, 'r+b')
+                fp.truncate(len(header) + len(body) // self.RECORD.itemsize * self.RECORD.itemsize)
+                fp.close()
+
+        if resumed:
+            print 'Resuming from manifest %s: %d tiles done, %d failed' % \
+                  (path, numpy.count_nonzero(self.states == self.DONE), numpy.count_nonzero(self.states == self.FAILED))
+        else:
+            fp = open(path, 'wb')
+            fp.write(header)
+            fp.close()
+        self.fp = open(path, 'ab')
+
+    def state(self, x, y):
+        return self.states[x - self.x0, y - self.y0]
+
+    def record(self, x, y, state, data=None):
+
+        size = 0
+        crc = 0
+        if data != None:
+            size = len(data)
+            crc = zlib.crc32(data) & 0xffffffff
+
+        self.lock.acquire()
+        try:
+            self.states[x - self.x0, y - self.y0] = state
+            self.sizes[x - self.x0, y - self.y0] = size
+            self.crcs[x - self.x0, y - self.y0] = crc
+            self.fp.write(struct.pack('<IIBII', x - self.x0, y - self.y0, state, size, crc))
+            self.fp.flush()
+        finally:
+            self.lock.release()
+
+    def check(self, x, y, data):
+
+        # True if data is what was recorded for a done tile
+        return self.state(x, y) == self.DONE and data != None and len(data) == self.sizes[x - self.x0, y - self.y0] and \
+               zlib.crc32(data) & 0xffffffff == self.crcs[x - self.x0, y - self.y0]
+
+    def close(self):
+        self.fp.close()
+
+
+# Returns True if data is a complete image: one PIL can open, and for JPEG and PNG, not truncated
+# (PIL only reads the header when opening, so a truncated tile would otherwise pass).
+def isCompleteImage(data):
+
+    if data == None:
+        return False
+    try:
+        im = Image.open(cStringIO.StringIO(data))
+    except:
+        return False
+    if im.format == 'JPEG':
+        return data.rstrip('\0\r\n ').endswith('\xff\xd9')
+    if im.format == 'PNG':
+        return data.endswith('IEND\xaeB`\x82')
+    return True
+
+
+# Returns True if data is a baseline JPEG image of 256x256 pixels, with 3 components subsampled 4:2:0
+# (i.e. like the Google tiles), which can be copied as it is into a JPEG compressed tiled TIFF.
+def isPassthroughJPEG(data):
+
+    if data == None or data[0:2] != '\xff\xd8':
+        return False
+
+    # walk the marker segments up to the start of frame
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != '\xff':
+            return False
+        marker = ord(data[pos+1])
+        length = struct.unpack('>H', data[pos+2:pos+4])[0]
+        if marker in (0xc0, 0xc1):
+            (precision, height, width, components) = struct.unpack('>BHHB', data[pos+4:pos+10])
+            sampling = [ord(data[pos+11+3*c]) for c in range(0, components)]
+            return precision == 8 and (width, height) == (256, 256) and sampling == [0x22, 0x11, 0x11]
+        if 0xc2 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+            # progressive, lossless or arithmetic coded
+            return False
+        pos += 2 + length
+    return False
+
+
+# Writes a JPEG compressed, tiled TIFF file one tile at a time (left to right, top to bottom), so
+# that tiles which are already JPEG streams can be stored as they are. Every tile must be a complete
+# baseline JPEG stream of tileSize x tileSize pixels, subsampled 4:2:0 (see isPassthroughJPEG).
+# If geo = (x, y, pixelSize) is given, GeoTIFF tags are written placing the top left corner of the
+# image at (x, y) in Web Mercator (EPSG:3857) metres. BigTIFF is used when the file may exceed 4 GB.
+class TiledTiffWriter:
+
+    def __init__(self, path, width, height, tileSize=256, geo=None):
+
+        self.width = width
+        self.height = height
+        self.tileSize = tileSize
+        self.geo = geo
+        self.tilesAcross = (width + tileSize - 1) // tileSize
+        self.tilesDown = (height + tileSize - 1) // tileSize
+        self.offsets = []
+        self.byteCounts = []
+
+        # JPEG tiles are far smaller than the raw pixels, so this is a safe estimate of the file size
+        self.big = self.tilesAcross * self.tilesDown * tileSize * tileSize * 3 > 0xffff0000
+
+        self.fp = open(path, 'wb')
+        if self.big:
+            self.fp.write('II' + struct.pack('<HHHQ', 43, 8, 0, 0))
+        else:
+            self.fp.write('II' + struct.pack('<HI', 42, 0))
+
+    def writeTile(self, data):
+
+        self.offsets.append(self.fp.tell())
+        self.byteCounts.append(len(data))
+        self.fp.write(data)
+        if self.fp.tell() & 1:
+            self.fp.write('\0')
+
+    def close(self):
+
+        SHORT = 3
+        LONG = 4
+        RATIONAL = 5
+        DOUBLE = 12
+        LONG8 = 16
+        offsetType = LONG
+        if self.big:
+            offsetType = LONG8
+
+        entries = [ (256, LONG, [self.width]),
+                    (257, LONG, [self.height]),
+                    (258, SHORT, [8, 8, 8]),
+                    (259, SHORT, [7]),                       # JPEG compression
+                    (262, SHORT, [6]),                       # YCbCr
+                    (277, SHORT, [3]),
+                    (284, SHORT, [1]),
+                    (322, LONG, [self.tileSize]),
+                    (323, LONG, [self.tileSize]),
+                    (324, offsetType, self.offsets),
+                    (325, LONG, self.byteCounts),
+                    (530, SHORT, [2, 2]),                    # 4:2:0 chroma subsampling
+                    (532, RATIONAL, [0, 1, 255, 1, 128, 1, 255, 1, 128, 1, 255, 1]) ]
+
+        if self.geo != None:
+            (x, y, pixelSize) = self.geo
+            entries += [ (33550, DOUBLE, [pixelSize, pixelSize, 0.0]),
+                         (33922, DOUBLE, [0.0, 0.0, 0.0, x, y, 0.0]),
+                         # projected model, pixels are areas, Web Mercator
+                         (34735, SHORT, [1, 1, 0, 3, 1024, 0, 1, 1, 1025, 0, 1, 1, 3072, 0, 1, 3857]) ]
+
+        formats = { SHORT: 'H', LONG: 'I', RATIONAL: 'I', DOUBLE: 'd', LONG8: 'Q' }
+        sizes = { SHORT: 2, LONG: 4, RATIONAL: 4, DOUBLE: 8, LONG8: 8 }
+
+        # the IFD goes at the end of the file, followed by the values which do not fit in its entries
+        ifdOffset = self.fp.tell()
+        if self.big:
+            (countFormat, entrySize, inlineSize, pointerFormat) = ('<Q', 20, 8, '<Q')
+        else:
+            (countFormat, entrySize, inlineSize, pointerFormat) = ('<H', 12, 4, '<I')
+        countSize = struct.calcsize(countFormat)
+        pointerSize = struct.calcsize(pointerFormat)
+        extraOffset = ifdOffset + countSize + len(entries) * entrySize + pointerSize
+
+        ifd = struct.pack(countFormat, len(entries))
+        extra = ''
+        for (tag, type, values) in entries:
+            packed = struct.pack('<%d%s' % (len(values), formats[type]), *values)
+            count = len(values)
+            if type == RATIONAL:
+                count = count // 2
+            if len(packed) <= inlineSize:
+                value = packed + '\0' * (inlineSize - len(packed))
+            else:
+                value = struct.pack(pointerFormat, extraOffset + len(extra))
+                extra += packed
+            if self.big:
+                ifd += struct.pack('<HHQ', tag, type, count) + value
+            else:
+                if extraOffset + len(extra) > 0xffffffff:
+                    raise IOError('TIFF file too large')
+                ifd += struct.pack('<HHI', tag, type, count) + value
+        ifd += struct.pack(pointerFormat, 0)
+
+        self.fp.write(ifd + extra)
+
+        # point the header at the IFD
+        if self.big:
+            self.fp.seek(8)
+            self.fp.write(struct.pack('<Q', ifdOffset))
+        else:
+            self.fp.seek(4)
+            self.fp.write(struct.pack('<I', ifdOffset))
+        self.fp.close()
+
+
+# Keeps a downscaled preview of a map up to date while its tiles download. The download threads only
+# put the (i, j) of each tile into self.landed as it is stored, and this thread decodes the tiles at
+# reduced size and pastes them into the preview, which is published every interval seconds if it has
+# changed: written to the file target, or passed (as a PIL image) to target if that is a function.
+# The preview can start from a coarse version of the whole map (see StitchedMap.coarsePreview).
+class PreviewRenderer( threading.Thread ):
+
+    def __init__(self, gmap, target, interval=2.0, size=1024):
+
+        self._stopevent = threading.Event()
+        self.gmap = gmap
+        self.target = target
+        self.interval = interval
+        self.landed = Queue.Queue(0)
+
+        # the preview is the cropped map, scaled down to at most size pixels along its long edge
+        self.box = gmap.getCropBox()
+        width  = self.box[2] - self.box[0]
+        height = self.box[3] - self.box[1]
+        self.scale = min(1.0, float(size) / max(width, height))
+        self.canvas = Image.new("RGB", (max(1, int(round(width * self.scale))), max(1, int(round(height * self.scale)))))
+        self.changed = False
+
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def join(self, timeout=None):
+
+        # stop once all the tiles landed so far are in the preview, and publish it a last time
+        self._stopevent.set()
+        threading.Thread.join(self, timeout)
+
+    def setBackground(self, im):
+
+        self.canvas = im.convert("RGB").resize(self.canvas.size, Image.BILINEAR)
+        self.changed = True
+        self.publish()
+
+    def placeTile(self, i, j):
+
+        tileBox = self.gmap.getTileBox(i, j)
+        x0 = int(round((tileBox[0] - self.box[0]) * self.scale))
+        y0 = int(round((tileBox[1] - self.box[1]) * self.scale))
+        x1 = int(round((tileBox[2] - self.box[0]) * self.scale))
+        y1 = int(round((tileBox[3] - self.box[1]) * self.scale))
+        if x1 <= x0 or y1 <= y0:
+            return
+
+        try:
+            im = Image.open(cStringIO.StringIO(self.gmap.loadTileData(self.gmap.getTileAt(i, j))))
+            im.draft("RGB", (x1 - x0, y1 - y0))
+            im = im.convert("RGB").resize((x1 - x0, y1 - y0), Image.BILINEAR)
+        except:
+            return
+        self.canvas.paste(im, (x0, y0))
+        self.changed = True
+
+    def publish(self):
+
+        if not self.changed:
+            return
+        self.changed = False
+        if callable(self.target):
+            self.target(self.canvas.copy())
+        else:
+            (root, ext) = os.path.splitext(self.target)
+            self.canvas.save(root + '.tmp' + ext)
+            os.rename(root + '.tmp' + ext, self.target)
+
+    def run( self ):
+
+        while True:
+            stopping = self._stopevent.isSet()
+            deadline = time.time() + self.interval
+            while True:
+                try:
+                    (i, j) = self.landed.get(not stopping, max(0.0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                self.placeTile(i, j)
+                if not stopping and time.time() >= deadline:
+                    break
+            self.publish()
+            if stopping:
+                return
+
+
+# A map of raw RGB pixels in a memory mapping, which stands in for a PIL image while stitching (tiles are
+# pasted into it, and windows of it are cropped out). With a path, the mapping is of a file on disk, so
+# the map can be larger than memory; the file is a binary PPM image (a short header followed by the rows)
+# and is removed by close() unless keep is set. Without a path, the mapping is anonymous shared memory.
+# Either way the mapping is shared with forked processes, which can fill in the canvas in parallel.
+class Canvas:
+
+    def __init__(self, width, height, path=None):
+
+        self.size = (width, height)
+        self.path = path
+        self.keep = False
+        self.fp = None
+        if path == None:
+            self.offset = 0
+            self.map = mmap.mmap(-1, max(3 * width * height, 1))
+        else:
+            # the file is extended without writing it, so it takes disk space only as it is filled in
+            header = 'P6\n%d %d\n255\n' % (width, height)
+            self.offset = len(header)
+            self.fp = open(path, 'w+b')
+            self.fp.write(header)
+            self.fp.truncate(self.offset + 3 * width * height)
+            self.fp.flush()
+            self.map = mmap.mmap(self.fp.fileno(), 0)
+
+    def paste(self, im, position):
+
+        # copy the pixels of im into the canvas a row at a time, with its top left corner at position
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        pixels = im.tobytes()
+        (x, y) = position
+        rowBytes = 3 * im.size[0]
+        for row in range(0, im.size[1]):
+            start = self.offset + 3 * ((y + row) * self.size[0] + x)
+            self.map[start:start + rowBytes] = pixels[row * rowBytes:(row + 1) * rowBytes]
+
+    def crop(self, box):
+
+        # image of a window of the canvas, read from the mapping a row at a time
+        rowBytes = 3 * (box[2] - box[0])
+        rows = []
+        for y in range(box[1], box[3]):
+            start = self.offset + 3 * (y * self.size[0] + box[0])
+            rows.append(self.map[start:start + rowBytes])
+        return Image.frombytes("RGB", (box[2] - box[0], box[3] - box[1]), ''.join(rows))
+
+    def image(self):
+
+        # the whole canvas as an image in memory
+        return Image.frombuffer("RGB", self.size, buffer(self.map, self.offset), "raw", "RGB", 0, 1)
+
+    def close(self):
+
+        self.map.close()
+        if self.fp != None:
+            self.fp.close()
+            if not self.keep:
+                os.remove(self.path)
+
+
+# Parallel stitching. The map is held in a Canvas, which a pool of processes fill in, each decoding and
+# placing a block of tiles. The (map, canvas, box) being stitched is put in parallelStitch before the
+# pool is created, so the forked processes inherit it.
+parallelStitch = None
+
+def stitchBlock(block):
+
+    (gmap, canvas, box) = parallelStitch
+    (i0, i1, j0, j1) = block
+    (hits, misses) = (tileCache.hits, tileCache.misses)
+    lost = []
+
+    for i in range(i0, i1):
+        for j in range(j0, j1):
+
+            tile = gmap.getTileAt(i, j)
+            if tile[3] == False:
+                continue
+
+            tileBox = gmap.scaleBox(gmap.getTileBox(i, j))
+            visible = gmap.clipBox(tileBox, box)
+            if visible == None:
+                continue
+
+            try:
+                im = gmap.loadTile(tile, gmap.scale)
+            except:
+                lost.append(gmap.makeKey(tile))
+                continue
+            gmap.pasteTile(canvas, im, tileBox, box)
+
+    # the number of tiles, the use of this process's decoded tile cache, and the keys of the tiles which
+    # could not be stitched, for the parent (which keeps the job's manifest and counts)
+    return ((i1 - i0) * (j1 - j0), tileCache.hits - hits, tileCache.misses - misses, lost)
+
+
+# Parallel encoding of map sheets: the map is put in sheetEncode before the pool is created, and each
+# process crops and saves the sheets it is given.
+sheetEncode = None
+
+def encodeSheet(sheet):
+
+    # sheetEncode is a PIL image, or a Canvas
+
+    (sheetpath, box) = sheet
+    sheetEncode.crop(box).save(sheetpath)
+    return sheetpath
+
+
+# Failed tiles are downloaded again after a delay, which doubles with each attempt, up to maxRetries
+# times. The RetryScheduler thread puts them back into grabPool when their time comes (the download
+# threads themselves must not, as grabPool is bounded). A tile stays unfinished in grabPool while it
+# waits, so that grabPool.join() waits for its retries too. Tiles which still fail are downloaded once
+# more in a gap-filling pass after all the others, if gapFillPass is set.
+maxRetries = 3
+retryDelay = 1.0
+gapFillPass = True
+
+class RetryScheduler( threading.Thread ):
+
+    def __init__(self):
+
+        self.waiting = []   # heap of (time due, sequence number, tile)
+        self.sequence = 0
+        self.condition = threading.Condition()
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def schedule(self, tile, delay):
+
+        self.condition.acquire()
+        heapq.heappush(self.waiting, (time.time() + delay, self.sequence, tile))
+        self.sequence += 1
+        self.condition.notify()
+        self.condition.release()
+
+    def run( self ):
+
+        while True:
+            self.condition.acquire()
+            while not self.waiting or self.waiting[0][0] > time.time():
+                if self.waiting:
+                    self.condition.wait(self.waiting[0][0] - time.time())
+                else:
+                    self.condition.wait()
+            (due, sequence, tile) = heapq.heappop(self.waiting)
+            self.condition.release()
+
+            # queue the tile again before finishing with the failed attempt, so that grabPool never
+            # appears to be finished in between
+            grabPool.put(tile)
+            grabPool.task_done()
+
+
+retryScheduler = None
+
+def startRetryScheduler():
+
+    global retryScheduler
+    if retryScheduler == None:
+        retryScheduler = RetryScheduler()
+        retryScheduler.start()
+    return retryScheduler
+
+
+# Called by the downloaders once they are done with a tile taken from grabPool
+# (data is the downloaded tile, or None if the download failed). The tile is always finished with here
+# (even if storing it fails, which counts as a failed download), unless it is handed to the retry
+# scheduler.
+def finishTile(tile, url, data):
+
+    retrying = False   # the retry scheduler finishes with the tile
+    ready = True       # the tile is ready to be stitched (pipelined mode)
+    try:
+        valid = False
+        if data == None:
+            progress("(Map URL " + url + " might be invalid, or a Google server might be refusing access.)")
+        else:
+            # Check the downloaded data is a complete image, straight from memory
+            valid = isCompleteImage(data)
+            if not valid:
+                # drop bad image
+                progress('Bad file detected for tile %s' % tileStore.describe(tile[1]))
+
+        if valid:
+            # For download-to-memory jobs the data is handed straight to the stitcher, and written to
+            # the tile store (if at all) in the background. Otherwise it goes into the tile store.
+            # The tile is recorded as done in the job manifest (if any) once it is in the store.
+            try:
+                memoryTiles = tile[4]
+                manifest = tile[6]
+                saved = None
+                if manifest != None:
+                    saved = lambda: manifest.record(tile[1][2], tile[1][3], JobManifest.DONE, data)
+                if memoryTiles != None:
+                    memoryTiles[tile[1]] = data
+                    if tile[5]:
+                        writeBehind.put(tile[1], data, saved)
+                else:
+                    tileStore.save(tile[1], data)
+                    if saved != None:
+                        saved()
+            except Exception as e:
+                progress('Tile %s could not be stored (%s)' % (tileStore.describe(tile[1]), e))
+                valid = False
+
+        if valid:
+            global numTilesDownloaded
+            global numTilesToDownload
+            LOCK.acquire()
+            numTilesDownloaded += 1
+            downloaded = numTilesDownloaded
+            LOCK.release()
+            metrics.tileDone(len(data))
+            progress('Tile downloaded (%d/%d) from url: %s ...' % (downloaded, numTilesToDownload, url))
+
+            if tile[10] != None:
+                tile[10].put(tile[3])
+
+        else:
+            attempts = tile[7]
+            if attempts < maxRetries:
+                delay = retryDelay * 2 ** attempts
+                tile[7] = attempts + 1
+                metrics.retry()
+                progress('Retrying tile %s in %.1f s (retry %d of %d)' % (tileStore.describe(tile[1]), delay, attempts + 1, maxRetries))
+                startRetryScheduler().schedule(tile, delay)
+                retrying = True
+                return
+
+            # out of retries: the tile is added to the job's list of failed tiles, and left for the
+            # gap-filling pass if there is to be one (so it only counts as failed after that)
+            tile[8].append(tile)
+            if tile[6] != None:
+                try:
+                    tile[6].record(tile[1][2], tile[1][3], JobManifest.FAILED)
+                except Exception as e:
+                    progress('Tile %s could not be recorded in the manifest (%s)' % (tileStore.describe(tile[1]), e))
+            if tile[9]:
+                ready = False
+                return
+            metrics.failure()
+
+    finally:
+        if not retrying:
+            # In pipelined mode, tell the stitcher that this tile is finished with (whether or not it succeeded)
+            if ready and tile[2] != None:
+                tile[2].put(tile[3])
+            grabPool.task_done()
+
+
+# Keeps the number of tile requests in flight near the point where throughput stops improving. The
+# completed requests are measured over windows of about a second: after a window where more than 5% of
+# the requests failed, or where responses were much slower than the fastest seen, the limit is cut by a
+# quarter, and after a window whose throughput was higher than the one before, it is raised by one. If
+# adaptive is False, the limit stays at its initial value.
+class ConcurrencyController:
+
+    def __init__(self, initial, maximum, minimum=1, adaptive=True):
+
+        self.limit = max(minimum, min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.inFlight = 0
+        self.condition = threading.Condition()
+
+        self.windowStart = time.time()
+        self.windowCount = 0
+        self.windowErrors = 0
+        self.windowLatency = 0.0
+        self.lastThroughput = 0.0
+        self.bestLatency = None
+
+    def acquire(self):
+
+        # wait for a free slot, for the blocking download threads
+        self.condition.acquire()
+        while self.inFlight >= self.limit:
+            self.condition.wait()
+        self.inFlight += 1
+        self.condition.release()
+
+    def release(self, latency, ok):
+
+        self.condition.acquire()
+        self.inFlight -= 1
+        self.sample(latency, ok)
+        self.condition.notify()
+        self.condition.release()
+
+    def sample(self, latency, ok):
+
+        # Record a completed request. Called by release(), or directly by a downloader which keeps
+        # its requests within self.limit itself. (The condition's lock is reentrant, so it can be
+        # taken here whether or not the caller already holds it.)
+        self.condition.acquire()
+        try:
+            self.windowCount += 1
+            self.windowLatency += latency
+            if not ok:
+                self.windowErrors += 1
+
+            elapsed = time.time() - self.windowStart
+            if not self.adaptive or elapsed < 1.0 or self.windowCount < 5:
+                return
+
+            throughput = self.windowCount / elapsed
+            latency = self.windowLatency / self.windowCount
+            if self.bestLatency == None or latency < self.bestLatency:
+                self.bestLatency = latency
+
+            if self.windowErrors > 0.05 * self.windowCount or latency > 2 * self.bestLatency + 0.05:
+                self.limit = max(self.minimum, self.limit * 3 // 4)
+            elif throughput > 1.05 * self.lastThroughput:
+                self.limit = min(self.maximum, self.limit + 1)
+                self.condition.notify_all()
+            self.lastThroughput = throughput
+
+            self.windowStart = time.time()
+            self.windowCount = 0
+            self.windowErrors = 0
+            self.windowLatency = 0.0
+        finally:
+            self.condition.release()
+
+
+# Chooses which of the load balanced servers (mt0-mt3, khm0-khm3) to send each request to, from their
+# observed response times and error rates: a request goes to the server expected to answer it soonest,
+# allowing for the requests it already has in flight. With a rate limit, each host is sent at most that
+# many requests per second, and the wait for a host's next slot also counts against choosing it.
+class ServerHealth:
+
+    def __init__(self, rateLimit=None):
+
+        self.rateLimit = rateLimit   # requests per second to each host, or None
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def choose(self, url, tried=()):
+
+        # Returns (url, host, delay): the url with the server filled in, and how many seconds to wait
+        # before requesting it. Servers in tried (a list of urls already tried for this tile) are only
+        # used again once all of them have been tried.
+        candidates = [url]
+        if url.find( "%s" ) != -1:
+            candidates = [url % n for n in range(4)]
+            untried = [candidate for candidate in candidates if candidate not in tried]
+            if untried:
+                candidates = untried
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            best = None
+            for candidate in candidates:
+                host = urlparse.urlsplit(candidate).netloc
+                stats = self.hosts.setdefault(host, {'latency': 0.0, 'errors': 0.0, 'inFlight': 0, 'next': 0.0,
+                                                     'requests': 0, 'failures': 0})
+                # servers not yet heard from have no latency, so they are tried first
+                cost = max(0.0, stats['next'] - now) + \
+                       stats['latency'] * (1 + stats['inFlight']) / (1.0 - min(stats['errors'], 0.9))
+                if best == None or cost < best[0]:
+                    best = (cost, candidate, host, stats)
+
+            (cost, url, host, stats) = best
+            stats['inFlight'] += 1
+            delay = 0.0
+            if self.rateLimit:
+                start = max(now, stats['next'])
+                stats['next'] = start + 1.0 / self.rateLimit
+                delay = start - now
+            return (url, host, delay)
+        finally:
+            self.lock.release()
+
+    def record(self, host, latency, ok):
+
+        # moving averages of the response time and error rate
+        self.lock.acquire()
+        try:
+            stats = self.hosts[host]
+            stats['inFlight'] -= 1
+            stats['requests'] += 1
+            if ok:
+                if stats['latency'] == 0.0:
+                    stats['latency'] = latency
+                stats['latency'] = 0.8 * stats['latency'] + 0.2 * latency
+                stats['errors'] = 0.8 * stats['errors']
+            else:
+                stats['failures'] += 1
+                stats['errors'] = 0.8 * stats['errors'] + 0.2
+        finally:
+            self.lock.release()
+
+    def report(self):
+
+        lines = []
+        for host in sorted(self.hosts.keys()):
+            stats = self.hosts[host]
+            lines.append('%s: %d requests, %d failed, %.0f ms average response' %
+                         (host, stats['requests'], stats['failures'], 1000 * stats['latency']))
+        return '\n'.join(lines)
+
+serverHealth = ServerHealth()
+
+
+# Download metrics: counts of tiles, bytes, requests, retries and failures, and a histogram of the
+# response times of each host. snapshot() returns them as a dict, along with the rates since the
+# previous snapshot and the depth of the download queue, and publish() passes a snapshot to each
+# listener added with addListener(). A MetricsReporter publishes them every so often, and can also
+# export them to a file as JSON or in the Prometheus text format.
+class DownloadMetrics:
+
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)   # upper bounds of the latency histogram, seconds
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.listeners = []
+        self.started = time.time()
+        self.tiles = 0
+        self.bytes = 0
+        self.requests = 0
+        self.retries = 0
+        self.failures = 0
+        self.hosts = {}
+        self.last = (self.started, 0, 0)   # (time, tiles, bytes) at the previous snapshot
+
+    def addListener(self, listener):
+        self.listeners.append(listener)
+
+    def removeListener(self, listener):
+        self.listeners.remove(listener)
+
+    def tileDone(self, size):
+
+        self.lock.acquire()
+        self.tiles += 1
+        self.bytes += size
+        self.lock.release()
+
+    def retry(self):
+
+        self.lock.acquire()
+        self.retries += 1
+        self.lock.release()
+
+    def failure(self):
+
+        # a tile given up on, after its retries
+        self.lock.acquire()
+        self.failures += 1
+        self.lock.release()
+
+    def request(self, host, latency, ok):
+
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            stats = self.hosts.get(host)
+            if stats == None:
+                stats = {'requests': 0, 'failures': 0, 'buckets': [0] * (len(self.BUCKETS) + 1), 'sum': 0.0}
+                self.hosts[host] = stats
+            stats['requests'] += 1
+            if not ok:
+                stats['failures'] += 1
+            n = 0
+            while n < len(self.BUCKETS) and latency > self.BUCKETS[n]:
+                n += 1
+            stats['buckets'][n] += 1
+            stats['sum'] += latency
+        finally:
+            self.lock.release()
+
+    def snapshot(self):
+
+        self.lock.acquire()
+        try:
+            now = time.time()
+            (lastTime, lastTiles, lastBytes) = self.last
+            interval = max(now - lastTime, 1e-6)
+            self.last = (now, self.tiles, self.bytes)
+
+            hosts = {}
+            for (host, stats) in self.hosts.items():
+                hosts[host] = {'requests': stats['requests'], 'failures': stats['failures'],
+                               'latencyBuckets': zip(list(self.BUCKETS) + ['+Inf'], stats['buckets']),
+                               'latencySum': stats['sum']}
+
+            snapshot = {'time': now, 'elapsed': now - self.started,
+                        'tiles': self.tiles, 'bytes': self.bytes, 'requests': self.requests,
+                        'retries': self.retries, 'failures': self.failures,
+                        'tilesPerSecond': (self.tiles - lastTiles) / interval,
+                        'bytesPerSecond': (self.bytes - lastBytes) / interval,
+                        'queueDepth': grabPool.qsize(), 'hosts': hosts}
+        finally:
+            self.lock.release()
+
+        if concurrency != None:
+            snapshot['concurrency'] = concurrency.limit
+        return snapshot
+
+    def publish(self):
+
+        snapshot = self.snapshot()
+        for listener in list(self.listeners):
+            listener(snapshot)
+        return snapshot
+
+    def prometheus(self, snapshot):
+
+        # the snapshot in the Prometheus text exposition format
+        lines = []
+        for (name, key, kind) in [('stitch_tiles_total', 'tiles', 'counter'), ('stitch_bytes_total', 'bytes', 'counter'),
+                                  ('stitch_requests_total', 'requests', 'counter'), ('stitch_retries_total', 'retries', 'counter'),
+                                  ('stitch_failures_total', 'failures', 'counter'), ('stitch_tiles_per_second', 'tilesPerSecond', 'gauge'),
+                                  ('stitch_bytes_per_second', 'bytesPerSecond', 'gauge'), ('stitch_queue_depth', 'queueDepth', 'gauge')]:
+            lines.append('# TYPE %s %s' % (name, kind))
+            lines.append('%s %s' % (name, snapshot[key]))
+
+        lines.append('# TYPE stitch_host_failures_total counter')
+        for host in sorted(snapshot['hosts'].keys()):
+            lines.append('stitch_host_failures_total{host="%s"} %d' % (host, snapshot['hosts'][host]['failures']))
+
+        lines.append('# TYPE stitch_request_duration_seconds histogram')
+        for host in sorted(snapshot['hosts'].keys()):
+            stats = snapshot['hosts'][host]
+            total = 0
+            for (bound, count) in stats['latencyBuckets']:
+                total += count
+                lines.append('stitch_request_duration_seconds_bucket{host="%s",le="%s"} %d' % (host, bound, total))
+            lines.append('stitch_request_duration_seconds_sum{host="%s"} %f' % (host, stats['latencySum']))
+            lines.append('stitch_request_duration_seconds_count{host="%s"} %d' % (host, stats['requests']))
+        return '\n'.join(lines) + '\n'
+
+metrics = DownloadMetrics()
+
+
+class MetricsReporter( threading.Thread ):
+
+    # Publishes the metrics every interval seconds, and if path is given, writes them to that file
+    # (replacing it each time), as 'json' or 'prometheus' text.
+    def __init__(self, interval=5.0, path=None, format='json'):
+
+        self._stopevent = threading.Event()
+        self.interval = interval
+        self.path = path
+        self.format = format
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+    def join(self, timeout=None):
+
+        self._stopevent.set()
+        threading.Thread.join(self, timeout)
+        self.report()
+
+    def report(self):
+
+        snapshot = metrics.publish()
+        if self.path == None:
+            return
+        if self.format == 'prometheus':
+            text = metrics.prometheus(snapshot)
+        else:
+            text = json.dumps(snapshot, indent=1, sort_keys=True)
+        fp = open(self.path + '.tmp', 'w')
+        fp.write(text)
+        fp.close()
+        os.rename(self.path + '.tmp', self.path)
+
+    def run( self ):
+
+        while not self._stopevent.wait(self.interval):
+            self.report()
+
+
+# Background threads. We start a few of these
+class ThreadingClass( threading.Thread ):
+
+    def __init__(self, concurrency=None):
+        
+        self._stopevent = threading.Event()
+        self.concurrency = concurrency
+        threading.Thread.__init__(self)
+
+    def join(self, timeout=None):
+        stopDownloader(self, timeout)
+
+    def run( self ):
+
+        # Run until termination event. After filling the queue, we can just wait until the queue is empty.
+        while True:
+
+            tile = grabPool.get()
+            if tile == None:
+                # a stop sentinel (see stopDownloader), which is ignored unless this thread is stopping
+                grabPool.task_done()
+                if self._stopevent.isSet():
+                    return
+                continue
+                
+            # For servers that had %s writted into them for load balancing, serverHealth fills in the
+            # server, and each of the 4 servers is tried in turn before giving up on the tile
+            attempts = 1
+            if( tile[0].find( "%s" ) != -1 ):
+                attempts = 4
+
+            tried = []
+            for x in range(attempts):
+                (url, host, delay) = serverHealth.choose(tile[0], tried)
+                tried.append(url)
+                if delay > 0:
+                    time.sleep(delay)
+
+                if self.concurrency != None:
+                    self.concurrency.acquire()
+                started = time.time()
+                data = self.download(url)
+                latency = time.time() - started
+                if self.concurrency != None:
+                    self.concurrency.release(latency, data != None)
+                serverHealth.record(host, latency, data != None)
+                metrics.request(host, latency, data != None)
+
+                if data != None: break
+
+            finishTile(tile, url, data)
+
+    def download( self, url ):
+         try:
+            fp = cStringIO.StringIO()
+            connectionPool.fetch(url, fp)
+            return fp.getvalue()
+         except:
+            return None
+
+
+
+# A single tile request made on a non-blocking socket, driven by the AsyncDownloader event loop.
+# The request is made with HTTP/1.0, so the server closes the connection at the end of the body.
+class TileRequest( asyncore.dispatcher ):
+
+    def __init__(self, downloader, tile, url, host, attempt, tried):
+
+        asyncore.dispatcher.__init__(self, map=downloader.channels)
+        self.downloader = downloader
+        self.tile = tile
+        self.url = url
+        self.host = host
+        self.attempt = attempt
+        self.tried = tried
+        self.started = time.time()
+        self.received = []
+        self.done = False
+
+        parts = urlparse.urlsplit(url)
+        path = parts.path
+        if parts.query:
+            path += '?' + parts.query
+        self.outgoing = 'GET %s HTTP/1.0\r\nHost: %s\r\n\r\n' % (path, parts.netloc)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            self.connect(downloader.resolve(parts.netloc))
+        except socket.error:
+            self.finish(None)
+
+    def writable(self):
+        return not self.connected or len(self.outgoing) > 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_write(self):
+        sent = self.send(self.outgoing)
+        self.outgoing = self.outgoing[sent:]
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if data:
+            self.received.append(data)
+
+    def handle_close(self):
+
+        # split off and check the response headers
+        response = ''.join(self.received)
+        body = None
+        end = response.find('\r\n\r\n')
+        if end != -1:
+            status = response[:response.find('\r\n')].split()
+            if len(status) > 1 and status[1] == '200':
+                body = response[end+4:]
+        self.finish(body)
+
+    def handle_error(self):
+        self.finish(None)
+
+    def finish(self, body):
+
+        if self.done:
+            return
+        self.done = True
+        self.close()
+        self.downloader.completed(self, body)
+
+
+# Alternative download backend to the ThreadingClass threads. A single thread runs an asyncore event
+# loop which takes the same work items from grabPool and keeps up to concurrency.limit tile requests
+# in flight at once, so that many simultaneous requests do not need as many OS threads.
+class AsyncDownloader( threading.Thread ):
+
+    def __init__(self, concurrency, timeout=30.0):
+
         self._stopevent = threading.Event()
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.channels = {}
+        self.addresses = {}
+        self.delayed = []   # requests held back by the rate limit: (start time, tile, url, host, attempt, tried)
         threading.Thread.__init__(self)
 
     def join(self, timeout=None):
+        stopDownloader(self, timeout)
+
+    def resolve(self, netloc):
+
+        # Look up (and remember) the address of each tile server
+        if netloc not in self.addresses:
+            host = netloc
+            port = 80
+            if ':' in netloc:
+                host, port = netloc.split(':')
+            self.addresses[netloc] = (socket.gethostbyname(host), int(port))
+        return self.addresses[netloc]
+
+    def start_request(self, tile, attempt, tried):
+
+        # Fixing up url for servers that had %s writted into them for load balancing
+        (url, host, delay) = serverHealth.choose(tile[0], tried)
+        tried.append(url)
+        if delay > 0:
+            self.delayed.append((time.time() + delay, tile, url, host, attempt, tried))
+        else:
+            TileRequest(self, tile, url, host, attempt, tried)
 
-        self._stopevent.set()
-        threading.Thread.join(self, timeout)
+    def completed(self, request, body):
+
+        tile = request.tile
+        latency = time.time() - request.started
+        try:
+            self.concurrency.sample(latency, body != None)
+            serverHealth.record(request.host, latency, body != None)
+            metrics.request(request.host, latency, body != None)
+        finally:
+            # the tile is always retried or finished, even if the bookkeeping fails, as otherwise
+            # grabPool.join() would wait for it forever
+            if body == None and tile[0].find( "%s" ) != -1 and request.attempt < 3:
+                # For load balanced servers, try each of the 4 servers in turn before giving up on the tile
+                self.start_request(tile, request.attempt + 1, request.tried)
+            else:
+                finishTile(tile, request.url, body)
 
     def run( self ):
 
-        self.serverSelectCounter = 0
+        while True:
 
-        # Run until termination event. After filling the queue, we can just wait until the queue is empty.
-        while not self._stopevent.isSet():
+            # start the rate limited requests whose time has come
+            if self.delayed:
+                now = time.time()
+                due = [request for request in self.delayed if request[0] <= now]
+                self.delayed = [request for request in self.delayed if request[0] > now]
+                for (start, tile, url, host, attempt, tried) in due:
+                    TileRequest(self, tile, url, host, attempt, tried)
 
-            try:
-                tile = grabPool.get(True, 0.001)
-            except:
-                continue
-                
-            url = tile[0]
-            output = './tiles/tile_' + tile[1] + '.jpg'
-            
-            # Fixing up url for servers that had %s writted into them for load balancing
-            gotTile = False
-            if( url.find( "%s" ) != -1 ):
-                for x in range(4):
-                    try:
-                        url = url % ( self.serverSelectCounter % 4 )
-                    except:
-                        pass
-                    self.serverSelectCounter = self.serverSelectCounter + 1
-                    gotTile = self.download(url, output)
-                    if gotTile: break
-                    
-            # Otherwise url does not need to be fixed up
-            else:    
-                gotTile = self.download(url, output)
-    
-            if (gotTile != True):
-                LOCK.acquire()
-                print "(Map URL " + url + " might be invalid, or a Google server might be refusing access.)"    
-                LOCK.release()            
-            else:
-                # Check file is a valid image
-                fp = None
-                LOCK.acquire()
-                global numTilesDownloaded
-                global numTilesToDownload
+            # top up the requests in flight from the queue, waiting for a tile if there is nothing to do
+            while len(self.channels) + len(self.delayed) < self.concurrency.limit:
                 try:
-                    fp = open(output, "rb")
-                    im = Image.open(fp)
-                    numTilesDownloaded += 1
-                    print 'Tile downloaded (%d/%d) from url: %s ...' % (numTilesDownloaded, numTilesToDownload, url)
-                except:
-                    # remove bad image
-                    print 'Bad file detected, ignoring tile %s (need to do another download pass to fill this hole)' % output
-                    if fp: fp.close()
-                    os.remove(output)
-                LOCK.release()
-                
-            grabPool.task_done()
+                    tile = grabPool.get(len(self.channels) + len(self.delayed) == 0, 1.0)
+                except Queue.Empty:
+                    break
+                if tile == None:
+                    # a stop sentinel (see stopDownloader), which is ignored unless this thread is stopping
+                    grabPool.task_done()
+                    if self._stopevent.isSet():
+                        return
+                    continue
+                self.start_request(tile, 0, [])
 
-    def download( self, url, output ):
-         try:
-            resp = urllib2.urlopen(url)
-            urllib.urlretrieve(url, output)
-            return True
-         except:
-            return False
+            if len(self.channels) == 0:
+                if self.delayed:
+                    time.sleep(0.001)
+                continue
+
+            asyncore.loop(timeout=0.01, map=self.channels, count=1)
+
+            # abandon requests which have taken too long
+            now = time.time()
+            for request in self.channels.values():
+                if now - request.started > self.timeout:
+                    request.finish(None)
+
+
+# Which download backend MainWindow starts: 'threads' for blocking ThreadingClass threads, or 'async'
+# for one AsyncDownloader. With adaptiveConcurrency, the downloaders start with numDownloadThreads
+# requests in flight and a ConcurrencyController adjusts that, up to maxDownloadThreads threads or
+# asyncConcurrency asynchronous requests. Otherwise numDownloadThreads threads, or asyncConcurrency
+# asynchronous requests, are used throughout.
+downloadBackend = 'threads'
+numDownloadThreads = 10
+maxDownloadThreads = 64
+asyncConcurrency = 200
+adaptiveConcurrency = True
+downloadTimeout = 30.0   # seconds before a request of the async downloader is given up
+concurrency = None
+
+def startDownloaders(backend=None):
+
+    global concurrency
+    if backend == None:
+        backend = downloadBackend
+
+    if backend == 'async':
+        if adaptiveConcurrency:
+            concurrency = ConcurrencyController(numDownloadThreads, asyncConcurrency)
+        else:
+            concurrency = ConcurrencyController(asyncConcurrency, asyncConcurrency, adaptive=False)
+        print "Starting asynchronous downloader (up to " + str(concurrency.maximum) + " requests in flight)"
+        threads = [ AsyncDownloader(concurrency, downloadTimeout) ]
+    elif adaptiveConcurrency:
+        concurrency = ConcurrencyController(numDownloadThreads, maxDownloadThreads)
+        print "Starting " + str(maxDownloadThreads) + " download threads, " + str(concurrency.limit) + " active at first"
+        threads = [ ThreadingClass(concurrency) for x in range(maxDownloadThreads) ]
+    else:
+        concurrency = None
+        print "Starting " + str(numDownloadThreads) + " download threads"
+        threads = [ ThreadingClass() for x in range(numDownloadThreads) ]
+
+    # keep as many idle connections as there can be requests in flight, so that none are closed and reopened
+    if backend != 'async':
+        connectionPool.maxsize = max(connectionPool.maxsize, len(threads))
+
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def stopDownloader(thread, timeout=None):
+
+    # The downloaders wait on grabPool, so they are stopped by putting None into it. Another idle
+    # downloader may take it first (and ignore it), so it is put again until this one has stopped.
+    # (stopDownloaders stops them all at once, without that.)
+    thread._stopevent.set()
+    started = time.time()
+    while thread.isAlive():
+        if timeout != None and time.time() - started >= timeout:
+            return
+        grabPool.put(None)
+        threading.Thread.join(thread, 0.1)
+
+
+def stopDownloaders(threads):
 
+    # once every downloader is stopping, each None put into grabPool stops one of them
+    grabPool.join()
+    for thread in threads:
+        thread._stopevent.set()
+    for thread in threads:
+        grabPool.put(None)
+    for thread in threads:
+        threading.Thread.join(thread)
+
+    if concurrency != None and concurrency.adaptive:
+        print 'Requests in flight at the end: %d' % concurrency.limit
+    print serverHealth.report()
+
+
+def discardDownloads():
+
+    # drop the tiles still queued for download (when a job has failed), and wait for those in flight
+    while True:
+        try:
+            grabPool.get_nowait()
+        except Queue.Empty:
+            break
+        grabPool.task_done()
+    grabPool.join()
 
 
 class StitchedMap:
 
-    def __init__(self, lat, lon, res, zoom, maptype):
+    def __init__(self, lat, lon, res, zoom, maptype, streaming=False, pipeline=False, inMemory=False, persist=True,
+                 pyramid=None, outputFormat='jpg', processes=1, sheetSize=4096, manifest=True,
+                 preview=None, previewInterval=2.0, previewSize=1024, exactSize=False, canvas=None):
 
         self.lat = lat
         self.lon = lon
         self.latVal = (float(lat[0]), float(lat[1]))
         self.lonVal = (float(lon[0]), float(lon[1]))
+        self.valid = False
 
         if (self.latVal[0] >= self.latVal[1]):
             print 'Invalid latitude range. Aborting.'
@@ -162,11 +2021,85 @@ class StitchedMap:
         if (self.lonVal[0] >= self.lonVal[1]):
             print 'Invalid longitude range. Aborting.'
             return
+        self.valid = True
         
         self.res = res
         self.zoom = zoom  # understood to be -1 if resolution specified
         self.maptype = maptype
 
+        # In streaming mode the map is assembled and written out one row of tiles at a time,
+        # so that peak memory is proportional to a single row of tiles rather than the whole map
+        self.streaming = streaming
+
+        # In pipelined mode tiles are stitched into the map as soon as they are downloaded, rather than
+        # after all the downloads have finished. Since the tiles arrive in any order, the whole map is held
+        # in memory, so pipelining is not combined with streaming.
+        self.pipeline = pipeline
+
+        # In download-to-memory mode, downloaded tiles are kept in memory and handed straight to the
+        # stitcher. They are also written to the tile store in the background if persist is set.
+        self.inMemory = inMemory
+        self.persist = persist
+        self.memoryTiles = None
+
+        # Lower resolution versions of the map can be made from the downloaded tiles, without downloading
+        # other zoom levels: pyramid='xyz' writes an XYZ tile tree (./pyramid_<name>/<zoom>/<x>/<y>.jpg)
+        # down to the level where the map fits in one tile, and pyramid='overviews' writes overview maps
+        # each half the size of the previous one.
+        self.pyramid = pyramid
+
+        # outputFormat is 'jpg', or 'tiff' for a JPEG compressed tiled TIFF whose 256x256 tiles coincide
+        # with the Google tiles, so that those can be copied into it without decoding and re-encoding.
+        # The left and top edges of the map are moved out to the tile grid to line the tiles up.
+        # The georeferencing is written as GeoTIFF tags and a world file.
+        # 'sheets' splits the map into sheets of sheetSize x sheetSize pixels, which are encoded in parallel
+        # as separate JPEG files, and lists them in an index file.
+        self.outputFormat = outputFormat
+        self.sheetSize = sheetSize
+
+        # If processes > 1, stitch() decodes and places the tiles in that many processes in parallel
+        # (the sheets are encoded in that many processes too, or one per core by default)
+        self.processes = processes
+
+        # If manifest is True, the state of each tile is kept in a job manifest file next to the map
+        # (see JobManifest), from which an interrupted job is resumed
+        self.useManifest = manifest
+        self.manifest = None
+
+        # tiles which could not be downloaded, even after retrying (see RetryScheduler), and the keys of
+        # the tiles which could not be stitched
+        self.failedTiles = []
+        self.lostTiles = set()
+
+        # If preview is given (a file name, or a function taking a PIL image), a preview of the map at
+        # most previewSize pixels across is made first from a few tiles of a lower zoom level, and then
+        # refined every previewInterval seconds with the tiles downloaded so far (see PreviewRenderer)
+        self.preview = preview
+        self.previewInterval = previewInterval
+        self.previewSize = previewSize
+        self.previewer = None
+
+        # If exactSize is set, the map is made exactly res pixels along its long edge (with the zoom level
+        # found from res rounded up, or as given). Where the tiles give the map at least twice that size,
+        # the JPEG tiles are decoded at 1/2, 1/4 or 1/8 of their size (which the decoder does cheaply, by
+        # skipping most of the inverse DCT) and stitched at that scale, before the map is resized to the
+        # exact size. When streaming, the map is only reduced by the decode scale. TIFF output copies the
+        # tiles as they are, so is made at full scale.
+        self.exactSize = exactSize and outputFormat != 'tiff'
+        self.scale = 1
+
+        # If canvas is given (a directory), the map is stitched in a Canvas file there rather than in
+        # memory, so that it can be larger than memory: the tiles are written into the file in place, and
+        # sheets are then cut from it a window at a time. Other output is encoded from the whole map,
+        # which needs it in memory, so a map too large for a JPEG file is left as the canvas (a PPM file).
+        # Streaming needs no canvas, and TIFF output is written tile by tile anyway.
+        self.canvas = canvas
+
+        # If keepMap is set, the stitched map is kept in self.stitched after it is saved (for compositing
+        # it with other layers, see LayeredMap)
+        self.keepMap = False
+        self.stitched = None
+
         self.MAP_MODE_PREFIX = self.makeDummyUrl(NRM_URL.split('&')[0])
         self.SAT_MODE_PREFIX = self.makeDummyUrl(SAT_URL.split('&')[0])
         self.PHY_MODE_PREFIX = self.makeDummyUrl(PHY_URL.split('&')[0])
@@ -184,6 +2117,11 @@ class StitchedMap:
 
         
     def generate(self):
+
+        # Returns the number of tiles which could not be downloaded (and so are black in the map),
+        # or None if the map could not be made at all.
+        if not self.valid:
+            return None
    
         c0 = "(" + self.lat[0] + ", " + self.lon[0] + ")"
         c1 = "(" + self.lat[1] + ", " + self.lon[1] + ")"
@@ -200,16 +2138,126 @@ class StitchedMap:
 
         if (self.zoom<0) or (self.zoom>19):
             print 'Invalid zoom level (' + str(self.zoom) + '). Aborting.'
-            return
+            return None
         print 'Zoom level: ', str(self.zoom)
 
+        if self.preview != None:
+            self.previewer = PreviewRenderer(self, self.preview, self.previewInterval, self.previewSize)
+            self.coarsePreview()
+            self.previewer.start()
+
         # Connect to Google maps and download tiles
         global numTilesDownloaded
         numTilesDownloaded = 0
-        self.download()
+        self.startJob()
+
+        if self.pipeline and not self.streaming and self.outputFormat != 'tiff':
+            self.downloadAndStitch()
+            self.stopPreview()
+
+        else:
+            self.download()
+            self.stopPreview()
+
+            # Finally stitch the downloaded maps together into the final big map
+            self.stitch()
+
+        if self.pyramid:
+            self.buildPyramid()
+
+        if tileStore.saved > 0:
+            print tileStore.report()
+        return self.finishJob()
+
+
+    def startJob(self):
+
+        # Set up the per-job state used while downloading, once the tile matrix is known
+        self.failedTiles = []
+        self.lostTiles = set()
+        if self.useManifest:
+            path = './stitched_' + self.makeIdentifier(self.getTileAt(0, 0)) + '.manifest'
+            self.manifest = JobManifest(path, self.maptype + ' ' + str(self.zoom), int(self.tileLng.min()),
+                                        int(self.tileLat.min()), self.nX, self.nY)
+
+        if self.inMemory:
+            self.memoryTiles = {}
+            if self.persist:
+                startWriteBehind()
+
+
+    def finishJob(self):
+
+        # Release the per-job state once the map is saved, and return the number of missing tiles
+        if self.inMemory:
+            # the map is saved, so now wait for the background tile writes to finish
+            if self.persist:
+                writeBehind.flush()
+            self.memoryTiles = None
+
+        # every tile which was queued and not downloaded ends up in failedTiles, and every tile which
+        # could not be stitched (including any lost from the tile store) in lostTiles
+        failedKeys = set([tile[1] for tile in self.failedTiles])
+        self.numMissing = len(failedKeys | self.lostTiles)
+
+        if self.manifest != None:
+            # this also counts stored tiles found to be corrupt while stitching, which could not be
+            # downloaded again. A complete job has nothing to resume, so its manifest is removed.
+            self.numMissing = max(self.numMissing, numpy.count_nonzero(self.manifest.states == JobManifest.FAILED))
+            self.manifest.close()
+            if self.numMissing == 0:
+                os.remove(self.manifest.path)
+            self.manifest = None
+
+        if self.numMissing > 0:
+            print '%d tiles could not be downloaded, and were rendered black' % self.numMissing
+        missing = ['%s (%s)' % (tileStore.describe(tile[1]), tile[0]) for tile in self.failedTiles[:20]]
+        missing += [tileStore.describe(key) for key in sorted(self.lostTiles - failedKeys)[:20 - len(missing)]]
+        for tile in missing:
+            print '\tmissing tile ' + tile
+        if self.numMissing > len(missing):
+            print '\t... and %d more' % (self.numMissing - len(missing))
+        return self.numMissing
+
+
+    def coarsePreview(self):
+
+        # Download the few tiles of the map at the zoom level which makes it about previewSize pixels
+        # across, and start the preview from them (if that zoom level is at least two below the map's,
+        # so that they are at most a sixteenth as many as the map's tiles)
+        coarse = StitchedMap(self.lat, self.lon, self.previewSize, -1, self.maptype, manifest=False)
+        coarse.computeTileMatrix()
+        if coarse.zoom > self.zoom - 2:
+            return
+
+        print 'Downloading %d tiles at zoom level %d for the preview ..' % (coarse.nX * coarse.nY, coarse.zoom)
+        coarse.download()
+
+        box = coarse.getCropBox()
+        Map = Image.new("RGB", (box[2] - box[0], box[3] - box[1]))
+        for i in range(0, coarse.nX):
+            for j in range(0, coarse.nY):
+                coarse.stitchTile(Map, box, i, j)
+        self.previewer.setBackground(Map)
 
-        # Finally stitch the downloaded maps together into the final big map
-        self.stitch()
+
+    def abandonJob(self):
+
+        # Clean up after generate failed part way, so that the next job starts afresh. The manifest is
+        # closed as it is, so that running the job again resumes it.
+        discardDownloads()
+        self.stopPreview()
+        if self.manifest != None:
+            self.manifest.close()
+            self.manifest = None
+
+
+    def stopPreview(self):
+
+        if self.previewer != None:
+            self.previewer.join()
+            self.previewer = None
+            print 'Preview finished'
 
        
     def computeTileRange(self):
@@ -233,6 +2281,10 @@ class StitchedMap:
             log2of10 = 3.321928094887362
             self.zoom = log2of10 * math.log10( max(self.ntiles_x, self.ntiles_y) * 360.0/max(EX, EY) )
 
+            # an exact size map is only ever reduced to size
+            if self.exactSize:
+                self.zoom = math.ceil(self.zoom)
+
         self.zoom = long(self.zoom)
 
         # In satellite mode, the zoom level in the html query goes from 0 to 14 inclusive,
@@ -306,35 +2358,99 @@ class StitchedMap:
         self.nX = abs(tileB[0] - tileA[0]) + 1
         self.nY = abs(tileB[1] - tileA[1]) + 1
 
+        # pixel dimensions of the (uncropped) map made of all the tiles
+        self.pX = 256 * self.nX
+        self.pY = 256 * self.nY
+
         print 'Total number of tiles to download: ' + str(self.nX*self.nY)
 
         # Make a nX*nY matrix of the tiles (i,j) we need, with (0,0) in the lower-left.
-        # The google tile indices (lng, lat) corresponding to (i,j) (at the given zoom level) are stored
-        # in each tile.
+        # The google tile indices (lng, lat) corresponding to (i,j) (at the given zoom level) are
+        # tileLng[i] and tileLat[j]. The individual tiles are only generated when needed (by getTileAt
+        # or iterTiles), so the memory used by the plan grows with nX+nY rather than nX*nY, except for
+        # the satellite tile codes (see computeTileCodes).
         
         # We need the fact that in satellite mode, the lng, lat tile indices increase with both longitude
         # and latitude, but in the other modes, the lat index decreases with latitude
-        self.tiles = []
+        self.tileLng = tileA[0] + numpy.arange(self.nX, dtype=numpy.int64)
+        if self.maptype == 'satellite':
+            self.tileLat = tileA[1] + numpy.arange(self.nY, dtype=numpy.int64)
+        else:
+            self.tileLat = tileA[1] - numpy.arange(self.nY, dtype=numpy.int64)
+        self.computeTileCodes()
+
+        # (i, j) of the tiles which are not available and will be left black
+        self.unavailable = set()
+
+        # the largest decode scale at which the map is still at least res pixels across
+        self.scale = 1
+        if self.exactSize:
+            box = self.getCropBox()
+            longEdge = max(box[2] - box[0], box[3] - box[1])
+            while self.scale < 8 and longEdge // (2 * self.scale) >= self.res:
+                self.scale *= 2
+            if self.scale > 1:
+                print 'Decoding tiles at 1/%d scale' % self.scale
+
+
+    def shareGeometry(self, other):
+
+        # Take the tile matrix computed by another map of the same area and zoom level, but perhaps of
+        # another type, rather than computing it again. The maps cover the same pixels; only the lat
+        # index of the tiles runs the other way between satellite mode and the others.
+        self.zoom = other.zoom
+        if self.maptype != 'satellite':
+            self.htmlzoom = 17 - self.zoom
+        self.yVal = other.yVal
+        (self.nX, self.nY, self.pX, self.pY) = (other.nX, other.nY, other.pX, other.pY)
+        self.scale = other.scale
+
+        self.tileLng = other.tileLng
+        self.tileLat = other.tileLat
+        if (self.maptype == 'satellite') != (other.maptype == 'satellite'):
+            self.tileLat = (1 << self.zoom) - 1 - other.tileLat
+        self.computeTileCodes()
+        self.unavailable = set()
+
+
+    def computeTileCodes(self):
+
+        # In satellite mode, the nX*nY matrix of tile codes, tileCodes[i, j] being the code of tile
+        # (i, j), so that getTileAt and iterTiles only look them up. It is filled a column at a time,
+        # keeping the temporary arrays of quadkeysToCodes small.
+        self.tileCodes = None
+        if self.maptype != 'satellite':
+            return
+        self.tileCodes = numpy.empty((self.nX, self.nY), dtype='S%d' % (self.zoom+1))
         for i in range(0, self.nX):
+            (quadkeys, valid) = satelliteQuadkeys(self.tileLng[i], self.tileLat, self.zoom)
+            self.tileCodes[i] = quadkeysToCodes(quadkeys, valid, self.zoom)
 
-            lng = tileA[0] + i
-            column = []
 
-            for j in range(0, self.nY):
+    def getTileAt(self, i, j):
 
-                lat = 0
-                if self.maptype == 'satellite':
-                    lat = tileA[1] + j
-                    code = self.genSatelliteTileCode(lng, lat)
-                else:
-                    lat = tileA[1] - j 
-                    code = ''
+        # tile (i, j) of the tile matrix, as [lng, lat, code, status]
+        code = ''
+        if self.tileCodes is not None:
+            code = str(self.tileCodes[i, j])
+        return [int(self.tileLng[i]), int(self.tileLat[j]), code, (i, j) not in self.unavailable]
+
+
+    def iterTiles(self):
 
-                status = True
-                tile = [lng, lat, code, status]
-                column.append(tile)
+        # Generate (i, j, tile) for every tile of the matrix, a column at a time
+        for i in range(0, self.nX):
+
+            lng = int(self.tileLng[i])
+            codes = None
+            if self.tileCodes is not None:
+                codes = self.tileCodes[i]
 
-            self.tiles.append(column) 
+            for j in range(0, self.nY):
+                code = ''
+                if codes is not None:
+                    code = str(codes[j])
+                yield (i, j, [lng, int(self.tileLat[j]), code, (i, j) not in self.unavailable])
 
 
     def checkURL(self, url):
@@ -349,42 +2465,155 @@ class StitchedMap:
 
     def download(self):
 
-        global numTilesToDownload
-        numTilesToDownload = 0
-
-        if os.path.exists("./tiles") != True:
-             os.mkdir("./tiles")
-
-        for column in self.tiles:
-            for tile in column:
-
-                tilePath = './tiles/tile_' + self.makeIdentifier(tile) + '.jpg'
-
-                # If the tile with the expected identifier suffix already exists in the tiles directory,
-                # assume that is the one we want (allows execution to continue later if interrupted).
-                if not os.path.exists(tilePath):
-                   
-                    mapurl = ''
-                    if self.maptype == 'map':              mapurl = self.gen_MAP_URL(tile)
-                    elif self.maptype == 'satellite':      mapurl = self.gen_SAT_URL(tile)       
-                    elif self.maptype == 'terrain':        mapurl = self.gen_PHY_URL(tile)
-                    elif self.maptype == 'sky':            mapurl = self.gen_SKY_URL(tile)
-                    else:
-                        print 'Unknown map type! Quitting. Humph'
-                        sys.exit()
-                        
-                    if mapurl:
-                        print 'Queuing tile (i, j) = (' + str(tile[0]) + ',' + str(tile[1]) + ') for download ..'
-                        grabPool.put( [ mapurl, self.makeIdentifier(tile) ] )
-                        numTilesToDownload += 1
-                    else:
-                        print 'Tile (i, j) = (' + str(tile[0]) + ',' + str(tile[1]) + ') is not stored by Google, and will be rendered black'
-                        tile[3] = False
+        self.queueDownloads()
    
         # Wait for all tile downloads to complete (or error)
         grabPool.join()   
 
 
+    def queueDownloads(self, readyPool=None):
+
+        # Queue the tiles which are not already in the tile store for download. The tiles are generated
+        # lazily and grabPool is bounded, so this blocks whenever the downloaders fall behind.
+        # If readyPool is given, the (i, j) indices of every tile are put into it once the tile is ready to
+        # be stitched: straight away for tiles already in the store (or unavailable), and by the download
+        # threads once they are finished with the others.
+        global numTilesToDownload
+        numTilesToDownload = 0
+
+        for work in self.planDownloads(readyPool):
+            numTilesToDownload += 1
+            grabPool.put(work)
+
+        if gapFillPass:
+            grabPool.join()
+            self.fillGaps()
+
+
+    def planDownloads(self, readyPool=None):
+
+        # Generate the work items for grabPool of the tiles which need downloading, handling the others
+        # (already stored or unavailable) on the way. The caller queues the items, so that the downloads
+        # of several maps can be interleaved (see LayeredMap).
+        for (i, j, tile) in self.iterTiles():
+
+            # If the tile is already in the tile store, assume that is the one we want (allows execution
+            # to continue later if interrupted). With a manifest, the tiles it records as done are taken
+            # to be stored if they are still in the store (they are checked when stitched), and failed
+            # ones are downloaded again; other tiles found in the store are checked to be complete, and
+            # recorded.
+            stored = False
+            if self.manifest == None:
+                stored = tileStore.contains(self.makeKey(tile))
+            else:
+                state = self.manifest.state(tile[0], tile[1])
+                if state == JobManifest.DONE:
+                    stored = tileStore.contains(self.makeKey(tile))
+                elif state == JobManifest.PENDING and tileStore.contains(self.makeKey(tile)):
+                    data = tileStore.load(self.makeKey(tile))
+                    if isCompleteImage(data):
+                        self.manifest.record(tile[0], tile[1], JobManifest.DONE, data)
+                        stored = True
+
+            if stored:
+                if readyPool != None:
+                    readyPool.put((i, j))
+                if self.previewer != None:
+                    self.previewer.landed.put((i, j))
+
+            else:
+               
+                mapurl = self.tileURL(tile)
+                if mapurl:
+                    progress('Queuing tile (i, j) = (' + str(tile[0]) + ',' + str(tile[1]) + ') for download ..')
+                    yield [ mapurl, self.makeKey(tile), readyPool, (i, j), self.memoryTiles, self.persist,
+                            self.manifest, 0, self.failedTiles, gapFillPass, self.previewQueue() ]
+                else:
+                    progress('Tile (i, j) = (' + str(tile[0]) + ',' + str(tile[1]) + ') is not stored by Google, and will be rendered black')
+                    self.unavailable.add((i, j))
+                    if readyPool != None:
+                        readyPool.put((i, j))
+
+
+    def fillGaps(self):
+
+        # Gap-filling pass: once everything else is finished, download the tiles which failed all
+        # their retries once more (with retries again), this time finishing with them either way
+        failed = self.failedTiles
+        self.failedTiles = []
+        if failed:
+            print '\nFilling gaps: downloading %d failed %s tiles again ..' % (len(failed), self.maptype)
+        for tile in failed:
+            tile[7] = 0
+            tile[8] = self.failedTiles
+            tile[9] = False
+            grabPool.put(tile)
+
+
+    def tileURL(self, tile):
+
+        # URL of the tile, with %s in place of the server number for load balanced servers
+        mapurl = ''
+        if self.maptype == 'map':              mapurl = self.gen_MAP_URL(tile)
+        elif self.maptype == 'satellite':      mapurl = self.gen_SAT_URL(tile)       
+        elif self.maptype == 'terrain':        mapurl = self.gen_PHY_URL(tile)
+        elif self.maptype == 'sky':            mapurl = self.gen_SKY_URL(tile)
+        else:
+            print 'Unknown map type! Quitting. Humph'
+            sys.exit()
+        return mapurl
+
+
+    def refetchTile(self, tile):
+
+        # Download a tile again straight away, for a stored tile found to be missing or corrupt while
+        # stitching (trying each of the load balanced servers, up to maxRetries times more). The tile is
+        # stored and recorded in the manifest. Returns its data, or None if it could not be downloaded.
+        key = self.makeKey(tile)
+        url = self.tileURL(tile)
+        data = None
+        tried = []
+        for attempt in range(0, maxRetries + 1):
+            if not url:
+                break
+            (server, host, delay) = serverHealth.choose(url, tried)
+            tried.append(server)
+            if delay > 0:
+                time.sleep(delay)
+            started = time.time()
+            fp = cStringIO.StringIO()
+            try:
+                connectionPool.fetch(server, fp)
+                data = fp.getvalue()
+            except:
+                data = None
+            ok = isCompleteImage(data)
+            serverHealth.record(host, time.time() - started, ok)
+            if ok:
+                break
+            data = None
+
+        if data == None:
+            self.manifest.record(tile[0], tile[1], JobManifest.FAILED)
+            return None
+        tileStore.save(key, data)
+        self.manifest.record(tile[0], tile[1], JobManifest.DONE, data)
+        return data
+
+
+    def previewQueue(self):
+
+        if self.previewer != None:
+            return self.previewer.landed
+        return None
+
+
+    def makeKey(self, tile):
+
+        # key of the tile in the tile store
+        return (self.maptype, self.zoom, tile[0], tile[1])
+
+
     def makeIdentifier(self, tile):
 
         identifier = self.maptype + '_' + str(self.zoom) + '_'
@@ -452,61 +2681,9 @@ class StitchedMap:
         return url
 
     
-    def convertToBinary(self, x, n):
-
-        b = ''
-        for i in range(0,n):
-            b = str((x >> i) & 1) + b
-        return b   
-
-           
     def genSatelliteTileCode(self, x, y):
 
-        # In satellite mode, the tiles are indexed by a sequence of the letters q, r, s, t, where
-        # there are 4^zoom tiles to index at each level. This works as indicated below:
-        #
-        #  zoom 0  zoom1      zoom 2              etc...
-        #
-        #  t       tq tr      tqq tqr   trq trr 
-        #          tt ts      tqt tqs   trt trs
-        #
-        #                     ttq ttr   tsq tsr 
-        #                     ttt tts   tst tss
-        
-        nTile = 1 << self.zoom
-       
-        if ((y < 0) or (nTile-1 < y)):
-            return 'x'
-        
-        if ((x < 0) or (nTile-1 < x)):
-            x = x % nTile
-            if (x < 0):
-                x += nTile;
-                
-        c = 't'
-
-        # convert each to zoom-digit binary representation 
-        bx = self.convertToBinary(x, self.zoom)
-        by = self.convertToBinary(y, self.zoom)
-
-        #                           q   r   s   t
-        #    left(0)/right(1) (x)   0   1   1   0
-        #    down(0)/up(1)    (y)   1   1   0   0
-
-        for i in range(0, self.zoom):
-
-            if (bx[i] == '0'):
-                if(by[i] == '0'):
-                    c += 't'
-                else:
-                    c += 'q'
-            else:
-                if(by[i] == '0'):
-                    c += 's'
-                else:
-                    c += 'r'
-               
-        return c
+        return satelliteTileCode(x, y, self.zoom)
 
 
     def getCoordsOfTile(self, tile):
@@ -529,14 +2706,14 @@ class StitchedMap:
         return [LL, UR]
 
 
-    def crop(self, Map):
+    def getCropBox(self):
 
-        # Crop off the excess space.
+        # Compute the box which crops off the excess space, in pixel coords of the uncropped map.
         # Get (lat, lon) in degrees of corners of image
-        tileA = self.tiles[0][0]
+        tileA = self.getTileAt(0, 0)
         coordsA = self.getCoordsOfTile(tileA)
         
-        tileB = self.tiles[self.nX-1][self.nY-1]
+        tileB = self.getTileAt(self.nX-1, self.nY-1)
         coordsB = self.getCoordsOfTile(tileB)
 
         LL = (coordsA[0][0], coordsA[0][1])
@@ -564,408 +2741,937 @@ class StitchedMap:
         if by<0: by=0;
         
         box = [ax, by, bx, ay]
-        return Map.crop(box)
+        return box
+
+
+    def getTileBox(self, i, j):
+
+        # pixel box of tile (i, j) in the uncropped map (tile (0, 0) is at the lower left)
+        cX = 256 * i
+        cY = self.pY - 256 * (j+1)
+        return [cX, cY, cX + 256, cY + 256]
+
+
+    def scaleBox(self, box):
+
+        # pixel box reduced to the decode scale (the tile boxes divide exactly)
+        return [v // self.scale for v in box]
+
+
+    def exactMap(self, Map):
+
+        # Map resized to exactly res pixels along its long edge, keeping the aspect ratio of the crop box
+        box = self.getCropBox()
+        (width, height) = (box[2] - box[0], box[3] - box[1])
+        if width >= height:
+            size = (self.res, max(1, int(round(float(self.res) * height / width))))
+        else:
+            size = (max(1, int(round(float(self.res) * width / height))), self.res)
+        if Map.size == size:
+            return Map
+        print 'Resizing map from %d x %d to %d x %d pixels' % (Map.size + size)
+        return Map.resize(size, Image.ANTIALIAS)
+
+
+    def clipBox(self, tileBox, box):
+
+        # intersection of two pixel boxes, or None if they do not overlap
+        x0 = max(tileBox[0], box[0])
+        y0 = max(tileBox[1], box[1])
+        x1 = min(tileBox[2], box[2])
+        y1 = min(tileBox[3], box[3])
+        if x0 >= x1 or y0 >= y1:
+            return None
+        return [x0, y0, x1, y1]
+
+
+    def pasteTile(self, Map, im, tileBox, box):
+
+        # Paste only the part of tile image im (which occupies tileBox in the uncropped map) that is
+        # visible within box, into Map whose top-left corner corresponds to the top-left of box.
+        visible = self.clipBox(tileBox, box)
+        if visible == None:
+            return
+        if visible != tileBox:
+            im = im.crop((visible[0] - tileBox[0], visible[1] - tileBox[1],
+                          visible[2] - tileBox[0], visible[3] - tileBox[1]))
+        Map.paste(im, (visible[0] - box[0], visible[1] - box[1]))
 
       
     def stitch(self):
 
         print '\nStitching tiles ...'
-        self.pX = 256 * self.nX
-        self.pY = 256 * self.nY
+        if self.outputFormat == 'tiff':
+            self.stitchTiff()
+            return
+        if self.streaming:
+            self.stitchStrips()
+            return
+        if self.processes > 1:
+            self.stitchParallel()
+            return
 
-        mode = "RGB"
-        Map = Image.new(mode, (self.pX, self.pY))
+        # Compute the final crop up front, so that only the output-sized map is allocated and
+        # only the visible part of each edge tile is copied into it
+        box = self.scaleBox(self.getCropBox())
+
+        Map = self.newMap(box[2] - box[0], box[3] - box[1])
 
         for i in range(0, self.nX):
             for j in range(0, self.nY):
+                self.stitchTile(Map, box, i, j)
 
-                print '\tprocessing tile %d, %d' % (i, j) 
-                tile = self.tiles[i][j]
-                if tile[3] == False:
-                    continue
-                
-                path = './tiles/tile_' + self.makeIdentifier(tile) + '.jpg'
+        self.saveMap(Map)
+        if isinstance(Map, Canvas):
+            Map.close()
 
-                # pixel coords of top left corner of this tile
-                cX = 256 * i
-                cY = self.pY - 256 * (j+1)
 
-                try:
-                    im = Image.open(path)
-                    Map.paste(im, (cX, cY))
-                except:
-                    continue
-                
-        cropMap = self.crop(Map)
-                    
+    def newMap(self, width, height):
+
+        # the map to stitch into: a Canvas file if there is a canvas directory, otherwise an image
+        if self.canvas == None:
+            return Image.new("RGB", (width, height))
+        path = os.path.join(self.canvas, 'stitched_' + self.makeIdentifier(self.getTileAt(0, 0)) + '.ppm')
+        print 'Stitching in canvas file %s (%.1f MB)' % (path, 3.0 * width * height / 1048576)
+        return Canvas(width, height, path)
+
+
+    def stitchTile(self, Map, box, i, j):
+
+        # Paste tile (i, j) into Map, which covers the given box of the uncropped map (at the decode scale)
+        progress('\tprocessing tile %d, %d' % (i, j))
+        tile = self.getTileAt(i, j)
+        if tile[3] == False:
+            return
+
+        # skip tiles which lie entirely outside the box
+        tileBox = self.scaleBox(self.getTileBox(i, j))
+        if self.clipBox(tileBox, box) == None:
+            return
+        
+        try:
+            im = self.loadTile(tile, self.scale)
+        except:
+            self.lostTile(self.makeKey(tile))
+            return
+        self.pasteTile(Map, im, tileBox, box)
+
+
+    def lostTile(self, key):
+
+        # record a tile which could not be stitched (it was not downloaded, or it is missing from the
+        # tile store), and so is black in the map
+        self.lostTiles.add(key)
+        if self.manifest != None:
+            self.manifest.record(key[2], key[3], JobManifest.FAILED)
+
+
+    def loadTile(self, tile, scale=1):
+
+        # Decoded image of the given tile at 1/scale of its size, from the decoded tile cache if possible.
+        # JPEG tiles are decoded straight to that size (in draft mode); others are decoded and resized.
+        data = self.loadTileData(tile)
+        if data == None:
+            raise IOError('tile %s is not available' % tileStore.describe(self.makeKey(tile)))
+        identifier = (hashlib.sha1(data).digest(), scale)
+        im = tileCache.get(identifier)
+        if im == None:
+            im = Image.open(cStringIO.StringIO(data))
+            size = (256 // scale, 256 // scale)
+            if scale > 1:
+                im.draft("RGB", size)
+            im.load()
+            if im.size != size:
+                im = im.resize(size, Image.ANTIALIAS)
+            tileCache.put(identifier, im)
+        return im
+
+
+    def loadTileData(self, tile):
+
+        # Undecoded data of the given tile, or None
+        key = self.makeKey(tile)
+        data = None
+        if self.memoryTiles != None:
+            data = self.memoryTiles.get(key)
+        if data == None:
+            data = tileStore.load(key)
+
+            # a stored tile which does not match the manifest has been lost from the store (or damaged)
+            # since it was downloaded, so it is downloaded again now
+            if self.manifest != None and self.manifest.state(tile[0], tile[1]) == JobManifest.DONE and \
+               not self.manifest.check(tile[0], tile[1], data):
+                print 'Tile %s is missing or corrupt in the tile store, downloading it again' % tileStore.describe(key)
+                data = self.refetchTile(tile)
+        return data
+
+
+    def saveMap(self, Map, name=None):
+
         # give the map file a semi-unique name, derived from the lower-left tile coords
-        mappath = './stitched_' + self.makeIdentifier(self.tiles[0][0]) + '.jpg'
-        cropMap.save(mappath)
+        if name == None:
+            name = './stitched_' + self.makeIdentifier(self.getTileAt(0, 0))
+
+        if isinstance(Map, Canvas):
+            # sheets are cut from a canvas a window at a time, but anything else needs the map in memory
+            if self.outputFormat == 'sheets' and not self.exactSize and not self.keepMap:
+                self.saveSheets(Map, name)
+                return
+            if Map.path != None and max(Map.size) > 65500:
+                Map.keep = True
+                print '\nThe map is too large for a JPEG file, and is left as the canvas ' + Map.path
+                return
+            Map = Map.image()
+
+        if self.exactSize:
+            Map = self.exactMap(Map)
+        if self.keepMap:
+            self.stitched = Map
+
+        if self.outputFormat == 'sheets':
+            self.saveSheets(Map, name)
+            return
+
+        mappath = name + '.jpg'
+        Map.save(mappath)
 
+        print tileCache.report()
         print '\nSaved stitched map ' + mappath
         print 'Finished.'
 
 
+    def saveSheets(self, Map, name):
 
-############################ wxPython GUI interface ############################
+        # Encoding one big JPEG is single threaded, and slow for a large map, so the map is instead cut
+        # into sheets that are encoded independently by a pool of processes. The index file lists each
+        # sheet with its position in the map.
+        global sheetEncode
 
-# Frame dimensions
-wX = 350
-wY = 450
+        (width, height) = Map.size
 
-# border width
-bW = 20
+        sheets = []
+        for y in range(0, height, self.sheetSize):
+            for x in range(0, width, self.sheetSize):
+                sheetpath = '%s_%d_%d.jpg' % (name, y // self.sheetSize, x // self.sheetSize)
+                sheets.append((sheetpath, (x, y, min(x + self.sheetSize, width), min(y + self.sheetSize, height))))
 
-# coord panel height
-hY = 180
+        processes = self.processes
+        if processes <= 1:
+            processes = multiprocessing.cpu_count()
 
-class TransparentText(wx.StaticText):
-  def __init__(self, parent, id=wx.ID_ANY, label='', pos=wx.DefaultPosition,
-             size=wx.DefaultSize, style=wx.TRANSPARENT_WINDOW, name='transparenttext'):
-    wx.StaticText.__init__(self, parent, id, label, pos, size, style, name)
+        print 'Encoding %d sheets in %d processes ...' % (len(sheets), processes)
+        sheetEncode = Map
+        pool = multiprocessing.Pool(processes)
+        try:
+            for sheetpath in pool.imap_unordered(encodeSheet, sheets):
+                progress('\tsaved sheet ' + sheetpath)
+        finally:
+            pool.close()
+            pool.join()
+            sheetEncode = None
+
+        indexpath = name + '_sheets.txt'
+        fp = open(indexpath, 'w')
+        fp.write('# map %d x %d pixels, %d sheets: file left top right bottom\n' % (width, height, len(sheets)))
+        for (sheetpath, box) in sheets:
+            fp.write('%s %d %d %d %d\n' % ((os.path.basename(sheetpath),) + box))
+        fp.close()
+
+        print tileCache.report()
+        print '\nSaved stitched map sheets, listed in ' + indexpath
+        print 'Finished.'
 
-    self.Bind(wx.EVT_PAINT, self.on_paint)
-    self.Bind(wx.EVT_ERASE_BACKGROUND, lambda event: None)
-    self.Bind(wx.EVT_SIZE, self.on_size)
 
-  def on_paint(self, event):
-    bdc = wx.PaintDC(self)
-    dc = wx.GCDC(bdc)
+    def downloadAndStitch(self):
 
-    font_face = self.GetFont()
-    font_color = self.GetForegroundColour()
+        # Pipelined version of download() followed by stitch(). The tiles are queued from a separate thread
+        # (as queuing blocks while the downloaders are busy), the download threads hand each finished tile
+        # back through readyPool, and the tiles are decoded and placed as they arrive, so that stitching
+        # proceeds while the network is busy rather than after it.
+        readyPool = Queue.Queue(0)
+        producer = threading.Thread(target=self.queueDownloads, args=(readyPool,))
+        producer.start()
 
-    dc.SetFont(font_face)
-    dc.SetTextForeground(font_color)
-    dc.DrawText(self.GetLabel(), 0, 0)
+        print '\nStitching tiles as they are downloaded ...'
+        box = self.scaleBox(self.getCropBox())
+        Map = self.newMap(box[2] - box[0], box[3] - box[1])
 
-  def on_size(self, event):
-    self.Refresh()
-    event.Skip()
+        # every tile comes through readyPool exactly once
+        for n in range(0, self.nX * self.nY):
+            (i, j) = readyPool.get()
+            self.stitchTile(Map, box, i, j)
 
+        producer.join()
+        grabPool.join()
+        self.saveMap(Map)
+        if isinstance(Map, Canvas):
+            Map.close()
 
 
-class MainPanel(wx.Panel):
+    def stitchParallel(self):
 
-    def OnSetFocus(self, evt):
-        print "OnSetFocus"
-        evt.Skip()
+        # Parallel version of stitch(). The grid of tiles is split into blocks, which a pool of processes
+        # decode and place into a canvas in shared memory, from which the map is then saved.
+        global parallelStitch
 
-    def OnKillFocus(self, evt):
-        print "OnKillFocus"
-        evt.Skip()
+        box = self.scaleBox(self.getCropBox())
+        canvas = self.newMap(box[2] - box[0], box[3] - box[1])
+        if not isinstance(canvas, Canvas):
+            canvas = Canvas(box[2] - box[0], box[3] - box[1])
 
-    def OnWindowDestroy(self, evt):
-        print "OnWindowDestroy"
-        evt.Skip()
+        blockSize = 8
+        blocks = []
+        for i0 in range(0, self.nX, blockSize):
+            for j0 in range(0, self.nY, blockSize):
+                blocks.append((i0, min(i0 + blockSize, self.nX), j0, min(j0 + blockSize, self.nY)))
 
-    def __init__(self, parent, id):
+        print 'Stitching %d blocks of tiles in %d processes ...' % (len(blocks), self.processes)
+        parallelStitch = (self, canvas, box)
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            done = 0
+            for (n, hits, misses, lost) in pool.imap_unordered(stitchBlock, blocks):
+                done += n
+                tileCache.hits += hits
+                tileCache.misses += misses
+                for key in lost:
+                    self.lostTile(key)
+                progress('\tprocessed %d/%d tiles' % (done, self.nX * self.nY))
+        finally:
+            pool.close()
+            pool.join()
+            parallelStitch = None
+
+        self.saveMap(canvas)
+        canvas.close()
+
+
+    def stitchTiff(self):
+
+        # Write the map as a tiled TIFF, tile by tile, so that no map sized image is ever held in memory.
+        # The image extends from the tile grid line at or left of/above the top left of the crop box, to its
+        # bottom right corner. Tiles entirely within the image are copied as they are when they are suitable
+        # JPEG streams, and the rest (the cropped tiles along the right and bottom edges, and any which are
+        # not suitable) are re-encoded.
+        box = self.getCropBox()
+        ox = box[0] - box[0] % 256
+        oy = box[1] - box[1] % 256
+        width = box[2] - ox
+        height = box[3] - oy
+
+        # georeferencing: Web Mercator metres of the top left corner, and the size of a pixel
+        geo = None
+        if self.maptype != 'sky':
+            halfWorld = math.pi * 6378137.0
+            pixelSize = 2.0 * halfWorld / (256 * (1 << self.zoom))
+            tx = int(self.tileLng[0]) + ox // 256
+            ty = self.xyzRow(int(self.tileLat[self.nY-1])) + oy // 256
+            geo = (-halfWorld + 256 * tx * pixelSize, halfWorld - 256 * ty * pixelSize, pixelSize)
+
+        name = './stitched_' + self.makeIdentifier(self.getTileAt(0, 0))
+        mappath = name + '.tif'
+        writer = TiledTiffWriter(mappath, width, height, 256, geo)
+
+        copied = 0
+        for tj in range(0, writer.tilesDown):
+            for ti in range(0, writer.tilesAcross):
+
+                i = ox // 256 + ti
+                j = self.nY - 1 - (oy // 256 + tj)
+                progress('\tprocessing tile %d, %d' % (i, j))
+                tile = self.getTileAt(i, j)
+
+                data = None
+                if tile[3]:
+                    data = self.loadTileData(tile)
+
+                # part of the tile within the image
+                tileBox = self.getTileBox(i, j)
+                visible = self.clipBox(tileBox, [ox, oy, box[2], box[3]])
+
+                if visible == tileBox and isPassthroughJPEG(data):
+                    writer.writeTile(data)
+                    copied += 1
+                    continue
 
-        self.parent = parent
+                im = Image.new("RGB", (256, 256))
+                if tile[3]:
+                    try:
+                        tileIm = self.loadTile(tile)
+                        self.pasteTile(im, tileIm, tileBox, [tileBox[0], tileBox[1], visible[2], visible[3]])
+                    except:
+                        self.lostTile(self.makeKey(tile))
+                fp = cStringIO.StringIO()
+                im.save(fp, 'JPEG', quality=90, subsampling=2)
+                writer.writeTile(fp.getvalue())
 
-        pos = wx.Point(bW,bW)
-        size = wx.Size(wX-2*bW, hY)
-        hspace = 4
-        wx.Panel.__init__(self, parent, -1, pos, size, style=wx.BORDER_SUNKEN)
+        writer.close()
 
-        self.frame = parent
-        self.Bind(wx.EVT_ERASE_BACKGROUND, self.OnEraseBackground)
+        if geo != None:
+            # world file, giving the centre of the top left pixel
+            fp = open(name + '.tfw', 'w')
+            fp.write('%.10f\n0.0\n0.0\n%.10f\n%.10f\n%.10f\n' % (geo[2], -geo[2], geo[0] + 0.5*geo[2], geo[1] - 0.5*geo[2]))
+            fp.close()
 
-        # Lat/Lng direct entry section
-        heading_LL = TransparentText(self, -1, "Lower left")
-        heading_UR = TransparentText(self, -1, "Upper right")
-        fW = 125
+        print '%d of %d tiles copied without re-encoding' % (copied, writer.tilesAcross * writer.tilesDown)
+        print '\nSaved stitched map ' + mappath
+        print 'Finished.'
 
-        lat_label = TransparentText(self, -1, "Latitude")
-        lon_label = TransparentText(self, -1, "Longitude")
-        
-        self.latLL_text  = wx.TextCtrl(self, -1, "-90.0", size=(fW, -1))
-        self.latLL_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.latLL_text)
-
-        self.lonLL_text  = wx.TextCtrl(self, -1, "-180.0", size=(fW, -1))
-        self.lonLL_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.lonLL_text)
-
-        self.latUR_text  = wx.TextCtrl(self, -1, "90.0", size=(fW, -1))
-        self.latUR_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.latUR_text)
-
-        self.lonUR_text  = wx.TextCtrl(self, -1, "180.0", size=(fW, -1))
-        self.lonUR_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.lonUR_text)
-
-        coord_sizer = wx.FlexGridSizer(cols=3, hgap=4*hspace, vgap=2*hspace)
-        coord_sizer.AddMany([ (0, 0),      heading_LL,      heading_UR,
-                            lat_label,   self.latLL_text, self.latUR_text,
-                            lon_label,   self.lonLL_text, self.lonUR_text,
-                            (0, 0), (0,0), (0,0) ])
-
-        # Lat/Lng code entry section
-        code_label = TransparentText(self, -1, "Code: ")
-        self.coordCode = wx.TextCtrl(self, -1, "", size=(fW*2, -1))
-        self.coordCode.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.coordCode)
-
-        useCode_cb = wx.CheckBox(self, -1, "Use code?", wx.DefaultPosition)
-        self.Bind( wx.EVT_CHECKBOX, self.EvtCoordCheckBox, useCode_cb)
-        self.useCode = False
-
-        code_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
-        code_sizer.AddMany([ useCode_cb, (0,0),
-                             code_label, self.coordCode,
-                             (0, 0), (0,0) ])
-
-        # 'Specify resolution' option enable checkbox
-        self.useRes_rb = wx.RadioButton(self, -1, "Specify resolution", wx.DefaultPosition)
-        self.useRes_rb.SetValue(True)
-        self.useRes_rb.SetTransparent(100)
-        self.Bind( wx.EVT_RADIOBUTTON, self.EvtResolutionRadioButton, self.useRes_rb)
-        self.useResolution = True
-
-        res_label = TransparentText(self, -1, "Approx. number of pixels: ")
-
-        self.res_text  = wx.TextCtrl(self, -1, "512", size=(fW/2, -1))
-        self.res_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.res_text)
-
-        res_sizer = wx.FlexGridSizer(cols=1, hgap=3*hspace, vgap=hspace)
-        res_sizer.AddMany([ self.useRes_rb, (0,0) ])
-
-        res_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
-        res_sizer.AddMany([ self.useRes_rb, (0,0),
-                            res_label, self.res_text,
-                            (0, 0), (0,0) ])
-
-        # 'Specify zoom level' option enable checkbox and entry
-        self.useZoom_rb = wx.RadioButton(self, -1, "Specify zoom level", wx.DefaultPosition)
-        self.useZoom_rb.SetValue(False)
-        self.useZoom_rb.SetTransparent(100)
-        self.Bind( wx.EVT_RADIOBUTTON, self.EvtZoomRadioButton, self.useZoom_rb)
-        self.useZoomLevel = False
-
-        self.zoomInfo_label = TransparentText(self, -1, "(min 0, max 19)")
-        zoom_label = TransparentText(self, -1, "Zoom level: ")
-
-        self.zoomLevel_text  = wx.TextCtrl(self, -1, "2", size=(fW/2, -1))
-        self.zoomLevel_text.SetInsertionPoint(0)
-        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.zoomLevel_text)
-        self.zoomLevel_text.Enable(False)
-
-        zoom_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
-        zoom_sizer.AddMany([ self.useZoom_rb, self.zoomInfo_label,
-                             zoom_label, self.zoomLevel_text,
-                             (0, 0), (0,0) ])
-
-        # Map type selection radio box
-        self.radioList = ['map', 'satellite', 'terrain', 'sky']
-        rb = wx.RadioBox(self, -1, "Map type", wx.DefaultPosition, wx.DefaultSize,
-                           self.radioList, 3, wx.RA_SPECIFY_COLS)
-        rb.SetTransparent(100)
-        self.Bind( wx.EVT_RADIOBOX, self.EvtRadioBox, rb)
-        self.maptype = 'map'
-
-        rbsizer = wx.BoxSizer(wx.HORIZONTAL)
-        rbsizer.Add(rb, 0, wx.GROW|wx.ALL, hspace)
-
-        # Tiles info
-        self.tilesInfo_label  = wx.StaticText(self, -1, '', size=(fW, -1))
-        # Run button
-        b = wx.Button(self, -1, "Run")
-        self.Bind(wx.EVT_BUTTON, self.OnRun, b)
-
-        bsizer = wx.BoxSizer(wx.HORIZONTAL)
-        bsizer.Add(b, 0, wx.GROW|wx.ALL, hspace)
-
-        # UI layout
-        border = wx.BoxSizer(wx.VERTICAL)
-        border.Add(coord_sizer, 0, wx.GROW)
-        border.Add(code_sizer, 0, wx.GROW)
-        border.Add(res_sizer, 0, wx.GROW)
-        border.Add(zoom_sizer, 0, wx.GROW)
-        border.Add(rbsizer, 0, wx.GROW)
-        border.AddSpacer(15)
-        border.Add(self.tilesInfo_label, 0, wx.GROW)
-        border.AddSpacer(5)
-        border.Add(bsizer, 0, wx.GROW)
-        
-        self.SetSizer(border)
-        self.SetAutoLayout(True)
-        border.Fit(self)
 
-        self.updateMapParams()
-        
+    def stitchStrips(self):
 
-    def OnEraseBackground(self, evt):
-        # Add a background image
-        dc = evt.GetDC()
-        if not dc:
-            dc = wx.ClientDC(self)
-            rect = self.GetUpdateRegion().GetBox()
-            dc.SetClippingRect(rect)
-        dc.Clear()
-        try:
-            if os.path.exists("./images/tov-stitch.jpg"):
-                    bmp = wx.Bitmap("./images/tov-stitch.jpg")
-                    dc.DrawBitmap(bmp, 0, 0)
-        except:
-            pass
-        
-    def updateMapParams(self):
+        # Streaming version of stitch(). Only one row of tiles is held in memory at a time: each row is
+        # pasted into a strip, cropped to the final map, and appended to a binary PPM file (the PPM format
+        # is simply a short header followed by the raw RGB rows, so it can be written incrementally).
+        box = self.scaleBox(self.getCropBox())
+        width  = box[2] - box[0]
+        height = box[3] - box[1]
 
-        lat = None
-        lon = None
+        mappath = './stitched_' + self.makeIdentifier(self.getTileAt(0, 0)) + '.ppm'
+        fp = open(mappath, 'wb')
+        fp.write('P6\n%d %d\n255\n' % (width, height))
 
-        if self.useCode == True:
+        # rows of tiles run from the top of the map (j = nY-1) to the bottom (j = 0)
+        for j in range(self.nY-1, -1, -1):
 
-            coords = self.coordCode.GetValue().split('_')
-            if len(coords) != 4:
-                print 'Code cannot be parsed into coordinates, unable to generate map.'
-                return False
+            # pixel rows of the cropped map covered by this row of tiles
+            tileBox = self.scaleBox(self.getTileBox(0, j))
+            top    = max(tileBox[1], box[1])
+            bottom = min(tileBox[3], box[3])
+            if top >= bottom:
+                continue
 
-            # Ensure that the 0th corner is lower left, even if the user didn't make it so
-            try:
-                lat = (coords[1], coords[3])
-                if float(lat[1]) < float(lat[0]): lat = (coords[3], coords[1])
-                lon = (coords[0], coords[2])
-                if float(lon[1]) < float(lon[0]):
-                    lon = (coords[2], coords[0])
-
-            except Exception as e: 
-                print 'Code cannot be parsed into coordinates, unable to generate map.'
-                print str(e)
-                return False
-                
-        else:
-            
-            # Ensure that the 0th corner is lower left, even if the user didn't make it so
-            lat = (self.latLL_text.GetValue(), self.latUR_text.GetValue())
+            stripBox = [box[0], top, box[2], bottom]
+            strip = Image.new("RGB", (width, bottom - top))
 
-            try:
-                if float(lat[1]) < float(lat[0]):
-                    lat = (self.latUR_text.GetValue(), self.latLL_text.GetValue())
-                lon = (self.lonLL_text.GetValue(), self.lonUR_text.GetValue())
-                if float(lon[1]) < float(lon[0]):
-                    lon = ( self.lonUR_text.GetValue(), self.lonLL_text.GetValue())
-            except Exception as e: 
-                print 'Invalid longitude/latitude values, unable to generate map.'
-                print str(e)
-                return False
+            for i in range(0, self.nX):
+                self.stitchTile(strip, stripBox, i, j)
 
-        zoomLevel = -1
-        if self.useZoom_rb.GetValue():
-            try:
-                zoomLevel = int(self.zoomLevel_text.GetValue())
-            except:
-                pass
+            fp.write(strip.tobytes())
+
+        fp.close()
+
+        print tileCache.report()
+        print '\nSaved stitched map ' + mappath
+        print 'Finished.'
 
-        res = 0
-        if self.useRes_rb.GetValue():
+
+
+    def xyzRow(self, lat):
+
+        # row index of a tile in the XYZ scheme, where rows increase downwards from the north
+        # (as in the map modes, whereas in satellite mode the lat index increases with latitude)
+        if self.maptype == 'satellite':
+            return (1 << self.zoom) - 1 - lat
+        return lat
+
+
+    def loadPyramidTile(self, root, k, x, y):
+
+        # Image of tile (x, y) of the XYZ tree at level self.zoom-k, or None if there is none.
+        # Level 0 comes from the downloaded tiles, the other levels from the tree built so far in root.
+        if k == 0:
+            i = x - int(self.tileLng[0])
+            j = abs(self.xyzRow(y) - int(self.tileLat[0]))
+            if i < 0 or i >= self.nX or j < 0 or j >= self.nY:
+                return None
+            tile = self.getTileAt(i, j)
+            if tile[3] == False:
+                return None
             try:
-               res = int(self.res_text.GetValue())
+                return self.loadTile(tile)
             except:
-                pass
+                return None
 
-        self.gmap = StitchedMap(lat, lon, res, zoomLevel, self.maptype)
+        path = os.path.join(root, str(self.zoom-k), str(x), str(y) + '.jpg')
+        if not os.path.exists(path):
+            return None
+        return Image.open(path)
 
-        tileRange = self.gmap.computeTileRange()
-        tileA = tileRange[0]
-        tileB = tileRange[1]
-        nX = abs(tileB[0] - tileA[0]) + 1
-        nY = abs(tileB[1] - tileA[1]) + 1
 
-        tileinfo = ' Will download ' + str(nX*nY) + ' tiles'
-        self.tilesInfo_label.SetLabel(tileinfo)
-        return True
-         
+    def buildPyramid(self):
 
-    def OnRun(self, evt):
-        if self.updateMapParams():
-            with grabPool.mutex:
-                grabPool.queue.clear()
-            grabPool.join()   
-            self.gmap.generate()
+        # Build the lower resolution levels by downsampling the tiles already fetched at self.zoom, one
+        # level at a time: each tile of a level is made from the 2x2 tiles below it in the previous level,
+        # so that only a handful of tiles are in memory at once.
+        print '\nBuilding ' + self.pyramid + ' pyramid ...'
 
+        # XYZ indices of the corner tiles of the tile matrix
+        x0 = int(self.tileLng[0])
+        x1 = int(self.tileLng[self.nX-1])
+        y0 = min(self.xyzRow(int(self.tileLat[0])), self.xyzRow(int(self.tileLat[self.nY-1])))
+        y1 = max(self.xyzRow(int(self.tileLat[0])), self.xyzRow(int(self.tileLat[self.nY-1])))
 
-    def EvtRadioBox(self, event):
-        maptype = ''
-        i = event.GetInt()
-        if i == 0:   self.maptype = 'map'
-        elif i == 1: self.maptype = 'satellite'
-        elif i == 2: self.maptype = 'terrain'
-        else: self.maptype = 'sky'
+        name = self.makeIdentifier(self.getTileAt(0, 0))
+        if self.pyramid == 'xyz':
+            root = './pyramid_' + name
+        else:
+            root = tempfile.mkdtemp(prefix='pyramid_')
+
+        # the full resolution level of an XYZ tree is just the downloaded tiles
+        if self.pyramid == 'xyz':
+            for (i, j, tile) in self.iterTiles():
+                data = None
+                if tile[3]:
+                    data = self.loadTileData(tile)
+                if data != None:
+                    directory = os.path.join(root, str(self.zoom), str(tile[0]))
+                    if not os.path.exists(directory):
+                        os.makedirs(directory)
+                    fp = open(os.path.join(directory, str(self.xyzRow(tile[1])) + '.jpg'), 'wb')
+                    fp.write(data)
+                    fp.close()
+
+        box = self.getCropBox()
+        k = 0
+        while (x0 >> k) != (x1 >> k) or (y0 >> k) != (y1 >> k):
+
+            k += 1
+            print '\tlevel %d' % (self.zoom-k)
+            for x in range(x0 >> k, (x1 >> k) + 1):
+
+                directory = os.path.join(root, str(self.zoom-k), str(x))
+                if not os.path.exists(directory):
+                    os.makedirs(directory)
+
+                for y in range(y0 >> k, (y1 >> k) + 1):
+                    im = Image.new("RGB", (256, 256))
+                    for dx in range(0, 2):
+                        for dy in range(0, 2):
+                            child = self.loadPyramidTile(root, k-1, 2*x + dx, 2*y + dy)
+                            if child != None:
+                                im.paste(child.resize((128, 128), Image.ANTIALIAS), (128*dx, 128*dy))
+                    im.save(os.path.join(directory, str(y) + '.jpg'))
+
+            if self.pyramid == 'overviews':
+                self.saveOverview(root, k, x0, y0, box)
+
+        if self.pyramid == 'xyz':
+            print 'Saved XYZ tile tree ' + root
+        else:
+            shutil.rmtree(root)
 
-        self.updateMapParams()
 
+    def saveOverview(self, root, k, x0, y0, box):
 
-    def EvtCoordCheckBox(self, event):
-        self.useCode = event.IsChecked()
-        if self.useCode:
-            self.coordCode.Enable(True)
-        else:
-            self.coordCode.Enable(False)
-        self.updateMapParams()
-         
-
-    def EvtResolutionRadioButton(self, event):
-        self.zoomLevel_text.Enable(False)
-        self.res_text.Enable(True)
-        self.updateMapParams()
-
-              
-    def EvtZoomRadioButton(self, event):
-        self.zoomLevel_text.Enable(True)
-        self.res_text.Enable(False)
-        self.updateMapParams()
-
-    def EvtTextChanged(self, event):
-        if self.useZoom_rb.GetValue():
-            zoomLevel = 0
-            try:
-                zoomLevel = int(self.zoomLevel_text.GetValue())
-            except:
-                pass
-            minZoom = 0
-            maxZoom = 19 
-            if (zoomLevel<minZoom):
-                zoomLevel = minZoom
-                self.zoomLevel_text.SetValue(str(zoomLevel))
-            if (zoomLevel>maxZoom):
-                zoomLevel = maxZoom
-                self.zoomLevel_text.SetValue(str(zoomLevel))
-            
-        self.updateMapParams()
+        # Stitch the level self.zoom-k tiles of the tree into an overview of the map, 1/2^k of its size.
+        # The crop box at this level is the full resolution one scaled down by 2^k, relative to the
+        # top-left tile of the level.
+        scale = float(1 << k)
+        gx = 256 * (x0 >> k)
+        gy = 256 * (y0 >> k)
+        overviewBox = [int((256*x0 + box[0])/scale) - gx, int((256*y0 + box[1])/scale) - gy,
+                       int((256*x0 + box[2])/scale) - gx, int((256*y0 + box[3])/scale) - gy]
+        if overviewBox[2] <= overviewBox[0] or overviewBox[3] <= overviewBox[1]:
+            return
 
+        Map = Image.new("RGB", (overviewBox[2] - overviewBox[0], overviewBox[3] - overviewBox[1]))
+        for x in range(x0 >> k, (overviewBox[2] + gx - 1)//256 + 1):
+            for y in range(y0 >> k, (overviewBox[3] + gy - 1)//256 + 1):
+                tileBox = [256*x - gx, 256*y - gy, 256*x - gx + 256, 256*y - gy + 256]
+                if self.clipBox(tileBox, overviewBox) == None:
+                    continue
+                im = self.loadPyramidTile(root, k, x, y)
+                if im != None:
+                    self.pasteTile(Map, im, tileBox, overviewBox)
+
+        mappath = './stitched_' + self.makeIdentifier(self.getTileAt(0, 0)) + '_overview' + str(k) + '.jpg'
+        Map.save(mappath)
+        print 'Saved overview ' + mappath
+
+
+# A job making maps of several types (layers) of the same area at the same zoom level in one run, e.g.
+# map, satellite and terrain. The tile matrix is computed once and shared by the layers, and their
+# downloads are interleaved through grabPool, rather than each layer waiting for the one before. If
+# opacities are given, the layers are also blended into a composite map, each over the ones before it
+# with its opacity (one for each layer after the first, or a single one for all of them). The other
+# options are those of StitchedMap, and apply to every layer; the preview is of the first layer.
+class LayeredMap:
+
+    def __init__(self, lat, lon, res, zoom, maptypes, opacities=None, **options):
+
+        options['pipeline'] = False   # the layers are stitched once all their tiles are in
+        self.layers = []
+        for n in range(0, len(maptypes)):
+            if n > 0:
+                options['preview'] = None
+            self.layers.append(StitchedMap(lat, lon, res, zoom, maptypes[n], **options))
+        self.valid = self.layers[0].valid
+
+        self.opacities = opacities
+        if opacities != None and len(opacities) == 1:
+            self.opacities = opacities * (len(maptypes) - 1)
+
+        # compositing needs the stitched layers in memory
+        base = self.layers[0]
+        self.composite = opacities != None and len(maptypes) > 1
+        if self.composite and (base.streaming or base.outputFormat == 'tiff'):
+            print 'Layers cannot be composited when streaming, or with TIFF output; making them separately.'
+            self.composite = False
+        for layer in self.layers:
+            layer.keepMap = self.composite
 
-class MainWindow(wx.Frame):
-    
-    def __init__(self, parent, id, title):
 
-        N = 10
-        print "*************** Stitch v3.0 ***************"
-        print "Starting " + str(N) + " download threads"
-        self.threads = []
-        
-        for x in range(N):
-            thread = ThreadingClass()
-            thread.start()
-            self.threads.append(thread)
-        wx.Frame.__init__(self, parent, wx.ID_ANY, title, wx.DefaultPosition, wx.Size(wX, wY), wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER)
-        controlPanel = MainPanel(self, -1)
-
-    def __del__(self):
-        grabPool.join()   
-        for thread in self.threads:
-            thread.join()
+    def generate(self):
+
+        # Returns the total number of tiles which could not be downloaded, or None if the maps could not
+        # be made at all
+        if not self.valid:
+            return None
+        if self.opacities != None and len(self.opacities) != len(self.layers) - 1:
+            print 'Give one opacity, or one for each layer after the first. Aborting.'
+            return None
+
+        base = self.layers[0]
+        c0 = "(" + base.lat[0] + ", " + base.lon[0] + ")"
+        c1 = "(" + base.lat[1] + ", " + base.lon[1] + ")"
+
+        print '\n######################################################################'
+        print "Making " + ', '.join([layer.maptype for layer in self.layers]) + " maps defined by (lat, lon) corners " + c0 + " and " + c1
+
+        base.computeTileMatrix()
+        if (base.zoom<0) or (base.zoom>19):
+            print 'Invalid zoom level (' + str(base.zoom) + '). Aborting.'
+            return None
+        print 'Zoom level: ', str(base.zoom)
+        for layer in self.layers[1:]:
+            layer.shareGeometry(base)
+
+        if base.preview != None:
+            base.previewer = PreviewRenderer(base, base.preview, base.previewInterval, base.previewSize)
+            base.coarsePreview()
+            base.previewer.start()
+
+        global numTilesDownloaded
+        numTilesDownloaded = 0
+        for layer in self.layers:
+            layer.startJob()
+
+        self.download()
+        base.stopPreview()
 
-        print "Terminated download threads. Quitting."
+        for layer in self.layers:
+            layer.stitch()
+            if layer.pyramid:
+                layer.buildPyramid()
 
- 
-# Entry point
-app = wx.PySimpleApp()
+        if self.composite:
+            self.compose()
 
-frame = MainWindow(None, -1, "Stitch")
-frame.Show(True)
+        if tileStore.saved > 0:
+            print tileStore.report()
 
-app.MainLoop()
+        missing = 0
+        for layer in self.layers:
+            missing += layer.finishJob()
+            layer.stitched = None
+        return missing
 
+
+    def abandonJob(self):
+
+        for layer in self.layers:
+            layer.abandonJob()
+            layer.stitched = None
+
+
+    def download(self):
+
+        # Queue the tiles of the layers in turn, one from each, so that every layer progresses together
+        # and the downloaders are never idle between layers
+        global numTilesToDownload
+        numTilesToDownload = 0
+
+        plans = [layer.planDownloads() for layer in self.layers]
+        while plans:
+            for plan in list(plans):
+                try:
+                    work = plan.next()
+                except StopIteration:
+                    plans.remove(plan)
+                    continue
+                numTilesToDownload += 1
+                grabPool.put(work)
+
+        if gapFillPass:
+            grabPool.join()
+            for layer in self.layers:
+                layer.fillGaps()
+
+        grabPool.join()
+
+
+    def compose(self):
+
+        # Blend the layers a band of rows at a time, as numpy arrays, so that the float arrays of the
+        # blend are only the size of a band rather than of the map
+        base = self.layers[0]
+        (width, height) = base.stitched.size
+        print '\nCompositing ' + ' over '.join([layer.maptype for layer in reversed(self.layers)]) + ' ...'
+
+        Map = Image.new("RGB", (width, height))
+        band = 256
+        for y in range(0, height, band):
+            rows = (0, y, width, min(y + band, height))
+            blend = numpy.asarray(base.stitched.crop(rows), dtype=numpy.float32)
+            for (layer, opacity) in zip(self.layers[1:], self.opacities):
+                top = numpy.asarray(layer.stitched.crop(rows), dtype=numpy.float32)
+                blend += opacity * (top - blend)
+            Map.paste(Image.fromarray(numpy.rint(blend).astype(numpy.uint8), "RGB"), (0, y))
+
+        base.keepMap = False
+        base.saveMap(Map, './stitched_composite_' + base.makeIdentifier(base.getTileAt(0, 0)))
+
+
+############################ Command line interface ############################
+
+def parseCode(code):
+
+    # Parse a coordinate code lonLL_latLL_lonUR_latUR (as given by stitch.html) into (lat, lon) ranges.
+    # Ensure that the 0th corner is lower left, even if the user didn't make it so.
+    coords = code.split('_')
+    if len(coords) != 4:
+        raise ValueError('Code ' + code + ' cannot be parsed into coordinates')
+
+    lat = (coords[1], coords[3])
+    if float(lat[1]) < float(lat[0]):
+        lat = (coords[3], coords[1])
+    lon = (coords[0], coords[2])
+    if float(lon[1]) < float(lon[0]):
+        lon = (coords[2], coords[0])
+    return (lat, lon)
+
+
+def parseMapTypes(value):
+
+    # Parse a comma separated list of map types, e.g. 'satellite,terrain'
+    maptypes = value.split(',')
+    for maptype in maptypes:
+        if maptype not in ['map', 'satellite', 'terrain', 'sky']:
+            raise ValueError('Unknown map type ' + maptype)
+    if len(set(maptypes)) != len(maptypes):
+        raise ValueError('Map type repeated in ' + value)
+    return maptypes
+
+
+def readJobFile(path, defaults):
+
+    # A job file has one map per line, given by its coordinate code optionally followed by any of
+    # res=<pixels>, zoom=<level> and type=<map|satellite|terrain|sky>, e.g.
+    #
+    #   174.70_-41.35_174.85_-41.20 res=4000 type=satellite
+    #
+    # The type may be several types separated by commas, to make a map of each in one run (see LayeredMap).
+    #
+    # Blank lines and lines starting with # are ignored. Settings not given are taken from defaults.
+    jobs = []
+    for line in open(path):
+
+        fields = line.split()
+        if not fields or fields[0].startswith('#'):
+            continue
+
+        job = dict(defaults)
+        (job['lat'], job['lon']) = parseCode(fields[0])
+        for field in fields[1:]:
+            (name, value) = field.split('=', 1)
+            if name == 'res':
+                job['res'] = int(value)
+                job['zoom'] = -1
+            elif name == 'zoom':
+                job['zoom'] = int(value)
+            elif name == 'type':
+                job['maptype'] = value
+            else:
+                raise ValueError('Unknown job setting ' + name + ' in ' + path)
+        jobs.append(job)
+
+    return jobs
+
+
+def printMetrics(snapshot):
+
+    sys.stdout.write('%d tiles, %.1f tiles/s, %.2f MB/s, %d retries, %d failed, %d queued\n' %
+                     (snapshot['tiles'], snapshot['tilesPerSecond'], snapshot['bytesPerSecond'] / 1048576.0,
+                      snapshot['retries'], snapshot['failures'], snapshot['queueDepth']))
+
+
+def main(argv=None):
+
+    if argv == None:
+        argv = sys.argv[1:]
+
+    parser = argparse.ArgumentParser(description='Assemble large Google maps from tiles. '
+                                     'Run without arguments to start the GUI.')
+    parser.add_argument('--gui', action='store_true', help='start the GUI (the default with no arguments)')
+
+    area = parser.add_argument_group('map')
+    area.add_argument('--lat', nargs=2, metavar=('LL', 'UR'), help='latitude of the lower left and upper right corners')
+    area.add_argument('--lon', nargs=2, metavar=('LL', 'UR'), help='longitude of the lower left and upper right corners')
+    area.add_argument('--code', help='corner coordinates as a code lonLL_latLL_lonUR_latUR (use --code=... if it starts with -)')
+    area.add_argument('--jobs', metavar='FILE', help='make every map listed in a job file, one per line')
+    area.add_argument('--res', type=int, default=512, help='approximate number of pixels along the long edge (default 512)')
+    area.add_argument('--zoom', type=int, default=-1, help='zoom level 0-19 (overrides --res)')
+    area.add_argument('--exact-size', action='store_true',
+                      help='make the map exactly --res pixels along its long edge (also with --zoom), decoding the tiles '
+                           'at 1/2, 1/4 or 1/8 scale where the zoom level gives at least twice as many pixels')
+    area.add_argument('--type', dest='maptype', default='map',
+                      help='map, satellite, terrain or sky, or several of them separated by commas (e.g. satellite,terrain) '
+                           'to make each from the same tile matrix, downloading them together (default map)')
+    area.add_argument('--composite', type=float, nargs='+', metavar='OPACITY',
+                      help='with several types, also blend each layer over the ones before it with this opacity (0-1), '
+                           'given once for all of them or once for each layer after the first')
+
+    modes = parser.add_argument_group('stitching')
+    modes.add_argument('--streaming', action='store_true', help='write the map one row of tiles at a time (PPM output)')
+    modes.add_argument('--pipeline', action='store_true', help='stitch tiles while they are downloading')
+    modes.add_argument('--in-memory', action='store_true', help='keep downloaded tiles in memory')
+    modes.add_argument('--no-persist', action='store_true', help='with --in-memory, do not write tiles to the tile store')
+    modes.add_argument('--format', dest='outputFormat', choices=['jpg', 'tiff', 'sheets'], default='jpg',
+                       help='output format; tiff writes a tiled TIFF, copying the JPEG tiles into it as they are, and '
+                            'sheets splits the map into JPEG sheets encoded in parallel, with an index file')
+    modes.add_argument('--sheet-size', type=int, default=4096, help='width and height of the sheets in pixels (default 4096)')
+    modes.add_argument('--pyramid', choices=['xyz', 'overviews'], help='also make lower resolution levels from the downloaded tiles')
+    modes.add_argument('--cache-mb', type=int, default=256, help='size of the decoded tile cache in MB (default 256)')
+    modes.add_argument('--no-manifest', action='store_true',
+                       help='do not keep a manifest of the tiles of each job, and resume by checking the tile store instead')
+    modes.add_argument('--preview', metavar='FILE', help='keep a small preview of each map in FILE while it downloads')
+    modes.add_argument('--preview-interval', type=float, default=2.0, help='seconds between preview updates (default 2)')
+    modes.add_argument('--preview-size', type=int, default=1024, help='size of the preview in pixels along its long edge (default 1024)')
+    modes.add_argument('--processes', type=int, default=1, help='number of processes to stitch with (default 1)')
+    modes.add_argument('--canvas', metavar='DIR',
+                       help='stitch in a memory mapped canvas file in DIR rather than in memory, for maps larger than memory '
+                            '(use with --format sheets, which are cut from the canvas a window at a time)')
+
+    downloads = parser.add_argument_group('downloading')
+    downloads.add_argument('--backend', choices=['threads', 'async'], default='threads')
+    downloads.add_argument('--threads', type=int, default=10,
+                           help='number of download threads, or of requests in flight at first when adaptive (default 10)')
+    downloads.add_argument('--max-threads', type=int, default=64, help='most download threads when adaptive (default 64)')
+    downloads.add_argument('--concurrency', type=int, default=200, help='most requests in flight with --backend async (default 200)')
+    downloads.add_argument('--fixed-concurrency', action='store_true',
+                           help='do not adjust the number of requests in flight to the observed throughput and errors')
+    downloads.add_argument('--retries', type=int, default=3, help='times to retry a failed tile, with exponential backoff (default 3)')
+    downloads.add_argument('--retry-delay', type=float, default=1.0, help='seconds before the first retry, doubling each time (default 1)')
+    downloads.add_argument('--no-gap-fill', action='store_true', help='do not retry failed tiles again after all the others')
+    downloads.add_argument('--host-rate', type=float, help='most requests per second to each tile server')
+    downloads.add_argument('--timeout', type=float, default=30.0, help='network timeout in seconds (default 30)')
+
+    reporting = parser.add_argument_group('progress and metrics')
+    reporting.add_argument('--quiet', action='store_true', help='do not print a line for every tile; print a summary every interval instead')
+    reporting.add_argument('--metrics', metavar='FILE', help='write download metrics to FILE every interval')
+    reporting.add_argument('--metrics-format', choices=['json', 'prometheus'],
+                           help='format of the metrics file (default prometheus for .prom files, otherwise json)')
+    reporting.add_argument('--metrics-interval', type=float, default=5.0, help='seconds between metrics reports (default 5)')
+
+    storage = parser.add_argument_group('tile store')
+    storage.add_argument('--store', default='./tiles', help='tile directory, or a .mbtiles file for a single-file SQLite store (default ./tiles)')
+    storage.add_argument('--store-max-mb', type=int, help='size cap of a .mbtiles store, evicting least recently used tiles')
+    storage.add_argument('--migrate-tiles', metavar='DIR', help='copy a ./tiles style directory into --store, then exit')
+
+    args = parser.parse_args(argv)
+
+    global tileStore, tileCache, connectionPool, downloadBackend, numDownloadThreads, asyncConcurrency
+    global maxDownloadThreads, adaptiveConcurrency, downloadTimeout, serverHealth, maxRetries, retryDelay, gapFillPass, printProgress
+    maxBytes = None
+    if args.store_max_mb != None:
+        maxBytes = args.store_max_mb * 1024 * 1024
+    if args.store.endswith('.mbtiles') or args.store.endswith('.sqlite'):
+        tileStore = SQLiteTileStore(args.store, maxBytes)
+    else:
+        tileStore = DirectoryTileStore(args.store)
+    tileCache = DecodedTileCache(args.cache_mb)
+    connectionPool = ConnectionPool(timeout=args.timeout)
+    downloadTimeout = args.timeout
+    downloadBackend = args.backend
+    numDownloadThreads = args.threads
+    maxDownloadThreads = args.max_threads
+    asyncConcurrency = args.concurrency
+    adaptiveConcurrency = not args.fixed_concurrency
+    serverHealth = ServerHealth(args.host_rate)
+    maxRetries = args.retries
+    retryDelay = args.retry_delay
+    gapFillPass = not args.no_gap_fill
+    printProgress = not args.quiet
+
+    if args.migrate_tiles:
+        migrateTileDirectory(args.migrate_tiles, tileStore)
+        return 0
+
+    if len(argv) == 0 or args.gui:
+        # only now import wx
+        import stitchgui
+        stitchgui.run()
+        return 0
+
+    defaults = { 'res': args.res, 'zoom': args.zoom, 'maptype': args.maptype }
+    try:
+        if args.jobs:
+            jobs = readJobFile(args.jobs, defaults)
+        else:
+            job = dict(defaults)
+            if args.code:
+                (job['lat'], job['lon']) = parseCode(args.code)
+            elif args.lat and args.lon:
+                (job['lat'], job['lon']) = parseCode('_'.join([args.lon[0], args.lat[0], args.lon[1], args.lat[1]]))
+            else:
+                parser.error('a map must be given by --lat and --lon, --code or --jobs')
+            jobs = [job]
+        for job in jobs:
+            job['maptypes'] = parseMapTypes(job['maptype'])
+    except (IOError, ValueError) as e:
+        print str(e)
+        return 2
+
+    print "*************** Stitch v3.0 ***************"
+    threads = startDownloaders()
+
+    reporter = None
+    if args.metrics or args.quiet:
+        metricsFormat = args.metrics_format
+        if metricsFormat == None:
+            metricsFormat = 'json'
+            if args.metrics and args.metrics.endswith('.prom'):
+                metricsFormat = 'prometheus'
+        if args.quiet:
+            metrics.addListener(printMetrics)
+        reporter = MetricsReporter(args.metrics_interval, args.metrics, metricsFormat)
+        reporter.start()
+
+    # exit status is 0 if all the maps are complete, 1 if any tiles are missing, 2 if any map failed
+    status = 0
+    for job in jobs:
+        options = { 'streaming': args.streaming, 'pipeline': args.pipeline,
+                    'inMemory': args.in_memory, 'persist': not args.no_persist,
+                    'pyramid': args.pyramid, 'outputFormat': args.outputFormat,
+                    'processes': args.processes, 'sheetSize': args.sheet_size, 'manifest': not args.no_manifest,
+                    'preview': args.preview, 'previewInterval': args.preview_interval, 'previewSize': args.preview_size,
+                    'exactSize': args.exact_size, 'canvas': args.canvas }
+        gmap = None
+        try:
+            if len(job['maptypes']) > 1:
+                gmap = LayeredMap(job['lat'], job['lon'], job['res'], job['zoom'], job['maptypes'], args.composite, **options)
+            else:
+                gmap = StitchedMap(job['lat'], job['lon'], job['res'], job['zoom'], job['maptype'], **options)
+            missing = gmap.generate()
+        except Exception as e:
+            # report the failure and go on with the remaining jobs
+            print 'Map failed: %s: %s' % (e.__class__.__name__, e)
+            if gmap != None:
+                gmap.abandonJob()
+            missing = None
+        if missing == None:
+            status = 2
+        elif missing > 0 and status == 0:
+            status = 1
+
+    stopDownloaders(threads)
+    if reporter != None:
+        reporter.join()
+    return status
+
+
+if __name__ == '__main__':
+    # run as the stitch module (rather than __main__), so that the GUI module shares its state
+    import stitch
+    sys.exit(stitch.main())
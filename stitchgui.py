@@ -0,0 +1,432 @@
+#! /bin/env python
+
+###################################################################################
+#                                                                                 #
+#  Stitch v3.0, wxPython GUI                                                      #
+#  http://www.jportsmouth.com/code/Stitch/stitch.html                             #
+#  Copyright (C) 2009-2010 Jamie Portsmouth (jamports@mac.com)                    #
+#                                                                                 #
+#  This program is free software: you can redistribute it and/or modify           #
+#  it under the terms of the GNU General Public License as published by           #
+#  the Free Software Foundation, either version 3 of the License, or              #
+#  (at your option) any later version.                                            #
+#                                                                                 #
+#  This program is distributed in the hope that it will be useful,                #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of                 #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                  #
+#  GNU General Public License for more details.                                   #
+#                                                                                 #
+#  You should have received a copy of the GNU General Public License              #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.          #
+#                                                                                 #
+###################################################################################
+
+# The GUI lives in its own module so that wx is only imported when the GUI is actually
+# requested; the map generation itself is in stitch.py. Run with "python stitch.py".
+
+import os
+import threading
+import wx
+import wx.html
+
+import stitch
+
+
+############################ wxPython GUI interface ############################
+
+# Frame dimensions
+wX = 350
+wY = 450
+
+# border width
+bW = 20
+
+# coord panel height
+hY = 180
+
+class TransparentText(wx.StaticText):
+  def __init__(self, parent, id=wx.ID_ANY, label='', pos=wx.DefaultPosition,
+             size=wx.DefaultSize, style=wx.TRANSPARENT_WINDOW, name='transparenttext'):
+    wx.StaticText.__init__(self, parent, id, label, pos, size, style, name)
+
+    self.Bind(wx.EVT_PAINT, self.on_paint)
+    self.Bind(wx.EVT_ERASE_BACKGROUND, lambda event: None)
+    self.Bind(wx.EVT_SIZE, self.on_size)
+
+  def on_paint(self, event):
+    bdc = wx.PaintDC(self)
+    dc = wx.GCDC(bdc)
+
+    font_face = self.GetFont()
+    font_color = self.GetForegroundColour()
+
+    dc.SetFont(font_face)
+    dc.SetTextForeground(font_color)
+    dc.DrawText(self.GetLabel(), 0, 0)
+
+  def on_size(self, event):
+    self.Refresh()
+    event.Skip()
+
+
+
+class MainPanel(wx.Panel):
+
+    def OnSetFocus(self, evt):
+        print "OnSetFocus"
+        evt.Skip()
+
+    def OnKillFocus(self, evt):
+        print "OnKillFocus"
+        evt.Skip()
+
+    def OnWindowDestroy(self, evt):
+        print "OnWindowDestroy"
+        evt.Skip()
+
+    def __init__(self, parent, id):
+
+        self.parent = parent
+
+        pos = wx.Point(bW,bW)
+        size = wx.Size(wX-2*bW, hY)
+        hspace = 4
+        wx.Panel.__init__(self, parent, -1, pos, size, style=wx.BORDER_SUNKEN)
+
+        self.frame = parent
+        self.Bind(wx.EVT_ERASE_BACKGROUND, self.OnEraseBackground)
+
+        # the thread making the current map, and the window showing its preview
+        self.running = None
+        self.previewFrame = None
+
+        # Lat/Lng direct entry section
+        heading_LL = TransparentText(self, -1, "Lower left")
+        heading_UR = TransparentText(self, -1, "Upper right")
+        fW = 125
+
+        lat_label = TransparentText(self, -1, "Latitude")
+        lon_label = TransparentText(self, -1, "Longitude")
+        
+        self.latLL_text  = wx.TextCtrl(self, -1, "-90.0", size=(fW, -1))
+        self.latLL_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.latLL_text)
+
+        self.lonLL_text  = wx.TextCtrl(self, -1, "-180.0", size=(fW, -1))
+        self.lonLL_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.lonLL_text)
+
+        self.latUR_text  = wx.TextCtrl(self, -1, "90.0", size=(fW, -1))
+        self.latUR_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.latUR_text)
+
+        self.lonUR_text  = wx.TextCtrl(self, -1, "180.0", size=(fW, -1))
+        self.lonUR_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.lonUR_text)
+
+        coord_sizer = wx.FlexGridSizer(cols=3, hgap=4*hspace, vgap=2*hspace)
+        coord_sizer.AddMany([ (0, 0),      heading_LL,      heading_UR,
+                            lat_label,   self.latLL_text, self.latUR_text,
+                            lon_label,   self.lonLL_text, self.lonUR_text,
+                            (0, 0), (0,0), (0,0) ])
+
+        # Lat/Lng code entry section
+        code_label = TransparentText(self, -1, "Code: ")
+        self.coordCode = wx.TextCtrl(self, -1, "", size=(fW*2, -1))
+        self.coordCode.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.coordCode)
+
+        useCode_cb = wx.CheckBox(self, -1, "Use code?", wx.DefaultPosition)
+        self.Bind( wx.EVT_CHECKBOX, self.EvtCoordCheckBox, useCode_cb)
+        self.useCode = False
+
+        code_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
+        code_sizer.AddMany([ useCode_cb, (0,0),
+                             code_label, self.coordCode,
+                             (0, 0), (0,0) ])
+
+        # 'Specify resolution' option enable checkbox
+        self.useRes_rb = wx.RadioButton(self, -1, "Specify resolution", wx.DefaultPosition)
+        self.useRes_rb.SetValue(True)
+        self.useRes_rb.SetTransparent(100)
+        self.Bind( wx.EVT_RADIOBUTTON, self.EvtResolutionRadioButton, self.useRes_rb)
+        self.useResolution = True
+
+        res_label = TransparentText(self, -1, "Approx. number of pixels: ")
+
+        self.res_text  = wx.TextCtrl(self, -1, "512", size=(fW/2, -1))
+        self.res_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.res_text)
+
+        res_sizer = wx.FlexGridSizer(cols=1, hgap=3*hspace, vgap=hspace)
+        res_sizer.AddMany([ self.useRes_rb, (0,0) ])
+
+        res_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
+        res_sizer.AddMany([ self.useRes_rb, (0,0),
+                            res_label, self.res_text,
+                            (0, 0), (0,0) ])
+
+        # 'Specify zoom level' option enable checkbox and entry
+        self.useZoom_rb = wx.RadioButton(self, -1, "Specify zoom level", wx.DefaultPosition)
+        self.useZoom_rb.SetValue(False)
+        self.useZoom_rb.SetTransparent(100)
+        self.Bind( wx.EVT_RADIOBUTTON, self.EvtZoomRadioButton, self.useZoom_rb)
+        self.useZoomLevel = False
+
+        self.zoomInfo_label = TransparentText(self, -1, "(min 0, max 19)")
+        zoom_label = TransparentText(self, -1, "Zoom level: ")
+
+        self.zoomLevel_text  = wx.TextCtrl(self, -1, "2", size=(fW/2, -1))
+        self.zoomLevel_text.SetInsertionPoint(0)
+        self.Bind( wx.EVT_TEXT, self.EvtTextChanged, self.zoomLevel_text)
+        self.zoomLevel_text.Enable(False)
+
+        zoom_sizer = wx.FlexGridSizer(cols=2, hgap=3*hspace, vgap=3*hspace)
+        zoom_sizer.AddMany([ self.useZoom_rb, self.zoomInfo_label,
+                             zoom_label, self.zoomLevel_text,
+                             (0, 0), (0,0) ])
+
+        # Map type selection radio box
+        self.radioList = ['map', 'satellite', 'terrain', 'sky']
+        rb = wx.RadioBox(self, -1, "Map type", wx.DefaultPosition, wx.DefaultSize,
+                           self.radioList, 3, wx.RA_SPECIFY_COLS)
+        rb.SetTransparent(100)
+        self.Bind( wx.EVT_RADIOBOX, self.EvtRadioBox, rb)
+        self.maptype = 'map'
+
+        rbsizer = wx.BoxSizer(wx.HORIZONTAL)
+        rbsizer.Add(rb, 0, wx.GROW|wx.ALL, hspace)
+
+        # Tiles info
+        self.tilesInfo_label  = wx.StaticText(self, -1, '', size=(fW, -1))
+        # Run button
+        b = wx.Button(self, -1, "Run")
+        self.Bind(wx.EVT_BUTTON, self.OnRun, b)
+
+        # Preview option: off by default, since the preview downloads tiles of a lower zoom level first
+        preview_cb = wx.CheckBox(self, -1, "Show preview", wx.DefaultPosition)
+        self.Bind( wx.EVT_CHECKBOX, self.EvtPreviewCheckBox, preview_cb)
+        self.showPreviewWindow = False
+
+        bsizer = wx.BoxSizer(wx.HORIZONTAL)
+        bsizer.Add(b, 0, wx.GROW|wx.ALL, hspace)
+        bsizer.Add(preview_cb, 0, wx.ALIGN_CENTER_VERTICAL|wx.ALL, hspace)
+
+        # UI layout
+        border = wx.BoxSizer(wx.VERTICAL)
+        border.Add(coord_sizer, 0, wx.GROW)
+        border.Add(code_sizer, 0, wx.GROW)
+        border.Add(res_sizer, 0, wx.GROW)
+        border.Add(zoom_sizer, 0, wx.GROW)
+        border.Add(rbsizer, 0, wx.GROW)
+        border.AddSpacer(15)
+        border.Add(self.tilesInfo_label, 0, wx.GROW)
+        border.AddSpacer(5)
+        border.Add(bsizer, 0, wx.GROW)
+        
+        self.SetSizer(border)
+        self.SetAutoLayout(True)
+        border.Fit(self)
+
+        self.updateMapParams()
+        
+
+    def OnEraseBackground(self, evt):
+        # Add a background image
+        dc = evt.GetDC()
+        if not dc:
+            dc = wx.ClientDC(self)
+            rect = self.GetUpdateRegion().GetBox()
+            dc.SetClippingRect(rect)
+        dc.Clear()
+        try:
+            if os.path.exists("./images/tov-stitch.jpg"):
+                    bmp = wx.Bitmap("./images/tov-stitch.jpg")
+                    dc.DrawBitmap(bmp, 0, 0)
+        except:
+            pass
+        
+    def updateMapParams(self):
+
+        lat = None
+        lon = None
+
+        if self.useCode == True:
+
+            coords = self.coordCode.GetValue().split('_')
+            if len(coords) != 4:
+                print 'Code cannot be parsed into coordinates, unable to generate map.'
+                return False
+
+            # Ensure that the 0th corner is lower left, even if the user didn't make it so
+            try:
+                lat = (coords[1], coords[3])
+                if float(lat[1]) < float(lat[0]): lat = (coords[3], coords[1])
+                lon = (coords[0], coords[2])
+                if float(lon[1]) < float(lon[0]):
+                    lon = (coords[2], coords[0])
+
+            except Exception as e: 
+                print 'Code cannot be parsed into coordinates, unable to generate map.'
+                print str(e)
+                return False
+                
+        else:
+            
+            # Ensure that the 0th corner is lower left, even if the user didn't make it so
+            lat = (self.latLL_text.GetValue(), self.latUR_text.GetValue())
+
+            try:
+                if float(lat[1]) < float(lat[0]):
+                    lat = (self.latUR_text.GetValue(), self.latLL_text.GetValue())
+                lon = (self.lonLL_text.GetValue(), self.lonUR_text.GetValue())
+                if float(lon[1]) < float(lon[0]):
+                    lon = ( self.lonUR_text.GetValue(), self.lonLL_text.GetValue())
+            except Exception as e: 
+                print 'Invalid longitude/latitude values, unable to generate map.'
+                print str(e)
+                return False
+
+        zoomLevel = -1
+        if self.useZoom_rb.GetValue():
+            try:
+                zoomLevel = int(self.zoomLevel_text.GetValue())
+            except:
+                pass
+
+        res = 0
+        if self.useRes_rb.GetValue():
+            try:
+               res = int(self.res_text.GetValue())
+            except:
+                pass
+
+        self.gmap = stitch.StitchedMap(lat, lon, res, zoomLevel, self.maptype)
+
+        tileRange = self.gmap.computeTileRange()
+        tileA = tileRange[0]
+        tileB = tileRange[1]
+        nX = abs(tileB[0] - tileA[0]) + 1
+        nY = abs(tileB[1] - tileA[1]) + 1
+
+        tileinfo = ' Will download ' + str(nX*nY) + ' tiles'
+        self.tilesInfo_label.SetLabel(tileinfo)
+        return True
+         
+
+    def OnRun(self, evt):
+        # the map is made in the background, so that the GUI can show its preview meanwhile
+        if self.running != None and self.running.isAlive():
+            print 'A map is already being made.'
+            return
+        if self.updateMapParams():
+            with stitch.grabPool.mutex:
+                stitch.grabPool.queue.clear()
+            stitch.grabPool.join()   
+            if self.showPreviewWindow:
+                self.gmap.preview = self.OnPreview
+            self.running = threading.Thread(target=self.gmap.generate)
+            self.running.daemon = True
+            self.running.start()
+
+
+    def OnPreview(self, im):
+        # called from the preview thread, so hand the image over to the GUI thread
+        wx.CallAfter(self.showPreview, im)
+
+
+    def showPreview(self, im):
+        image = wx.EmptyImage(im.size[0], im.size[1])
+        image.SetData(im.tobytes())
+        if self.previewFrame == None:
+            self.previewFrame = wx.Frame(self, wx.ID_ANY, 'Stitch preview', size=(im.size[0], im.size[1] + 30))
+            self.previewBitmap = wx.StaticBitmap(self.previewFrame, wx.ID_ANY, wx.BitmapFromImage(image))
+            self.previewFrame.Bind(wx.EVT_CLOSE, self.OnPreviewClose)
+            self.previewFrame.Show(True)
+        else:
+            self.previewBitmap.SetBitmap(wx.BitmapFromImage(image))
+
+
+    def OnPreviewClose(self, evt):
+        self.previewFrame.Destroy()
+        self.previewFrame = None
+
+
+    def EvtRadioBox(self, event):
+        maptype = ''
+        i = event.GetInt()
+        if i == 0:   self.maptype = 'map'
+        elif i == 1: self.maptype = 'satellite'
+        elif i == 2: self.maptype = 'terrain'
+        else: self.maptype = 'sky'
+
+        self.updateMapParams()
+
+
+    def EvtPreviewCheckBox(self, event):
+        self.showPreviewWindow = event.IsChecked()
+
+
+    def EvtCoordCheckBox(self, event):
+        self.useCode = event.IsChecked()
+        if self.useCode:
+            self.coordCode.Enable(True)
+        else:
+            self.coordCode.Enable(False)
+        self.updateMapParams()
+         
+
+    def EvtResolutionRadioButton(self, event):
+        self.zoomLevel_text.Enable(False)
+        self.res_text.Enable(True)
+        self.updateMapParams()
+
+              
+    def EvtZoomRadioButton(self, event):
+        self.zoomLevel_text.Enable(True)
+        self.res_text.Enable(False)
+        self.updateMapParams()
+
+    def EvtTextChanged(self, event):
+        if self.useZoom_rb.GetValue():
+            zoomLevel = 0
+            try:
+                zoomLevel = int(self.zoomLevel_text.GetValue())
+            except:
+                pass
+            minZoom = 0
+            maxZoom = 19 
+            if (zoomLevel<minZoom):
+                zoomLevel = minZoom
+                self.zoomLevel_text.SetValue(str(zoomLevel))
+            if (zoomLevel>maxZoom):
+                zoomLevel = maxZoom
+                self.zoomLevel_text.SetValue(str(zoomLevel))
+            
+        self.updateMapParams()
+
+
+class MainWindow(wx.Frame):
+    
+    def __init__(self, parent, id, title):
+
+        print "*************** Stitch v3.0 ***************"
+        self.threads = stitch.startDownloaders()
+        wx.Frame.__init__(self, parent, wx.ID_ANY, title, wx.DefaultPosition, wx.Size(wX, wY), wx.DEFAULT_FRAME_STYLE ^ wx.RESIZE_BORDER)
+        controlPanel = MainPanel(self, -1)
+
+    def __del__(self):
+        stitch.stopDownloaders(self.threads)
+
+        print "Terminated download threads. Quitting."
+
+ 
+# Entry point, called from stitch.main()
+def run():
+
+    app = wx.PySimpleApp()
+
+    frame = MainWindow(None, -1, "Stitch")
+    frame.Show(True)
+
+    app.MainLoop()